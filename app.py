@@ -3,11 +3,38 @@
 # print("Содержимое папки:", os.listdir('.'))
 
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g, session, Response, stream_with_context
 from dotenv import load_dotenv
+import click
 import os
+import csv
+import queue
+import hashlib
+import io
+import math
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+import time
+from datetime import date as date_type, timedelta
+from db import ConnectionPool, PoolTimeout, default_pragmas
+from migrations import migrate
+import storage
+import archive
+import serialization
+import importer
+import metrics
+import planning
+import forecast
+import balance
+from events import ChangeHub, format_event
+from user_cache import UserCache
+from ledger import LedgerCache
+from fragments import FragmentCache
+from markupsafe import Markup
+import compressor
+from hashing import PasswordHasher, HashingBusy
+from group_commit import GroupCommitWriter, WriterBusy
+from shards import ShardRouter, ShardMoving, init_shard, shard_paths
+import backup
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 
 load_dotenv()
@@ -17,89 +44,354 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'default-secret-key')
 
 DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
 
-DATABASE = os.path.join(os.path.dirname(__file__), 'budget.db')
+DATABASE = os.environ.get('DATABASE_URL') or os.path.join(os.path.dirname(__file__), 'budget.db')
 #DATABASE = "budget.db"
+
+# Настройки пула соединений с SQLite. Каждый поток воркера держит соединение на время
+# запроса, поэтому DB_POOL_SIZE не меньше --threads в Procfile
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '16'))
+DB_CACHED_STATEMENTS = int(os.environ.get('DB_CACHED_STATEMENTS', '256'))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Кэш пользователей для Flask-Login
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))
+# Хранить имя пользователя в подписанной сессии, чтобы не обращаться к БД вовсе
+USER_SESSION_AUTH = os.environ.get('USER_SESSION_AUTH', 'False').lower() == 'true'
+
+# Колоночный кэш неархивных расходов для /expenses, МБ на воркер (0 — выключен). Окупается у тех,
+# кто много листает и фильтрует между записями; после записи журнал догоняется по журналу изменений.
+LEDGER_CACHE_MB = float(os.environ.get('LEDGER_CACHE_MB', '0'))
+# Отрисованная первая страница главной по пользователям (0 — не кэшировать)
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', '1024'))
+# Горизонт архивации по умолчанию для flask archive-expenses: расходы старше стольких дней
+# переносятся в архивные таблицы по годам
+ARCHIVE_KEEP_DAYS = int(os.environ.get('ARCHIVE_KEEP_DAYS', '730'))
+
+# Хэширование паролей: метод Werkzeug (scrypt:N:r:p или pbkdf2:sha256:итерации),
+# число процессов пула (0 — считать в самом воркере), длина очереди и таймаут
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', '2'))
+HASH_QUEUE_SIZE = int(os.environ.get('HASH_QUEUE_SIZE', '8'))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', '10'))
+
+# Импорт выписок: строк в одной транзакции
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '5000'))
+# Максимум операций в одном пакете /api/expenses/batch
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '1000'))
+
+# Server-Sent Events: как часто проверять журнал изменений, интервал keepalive
+# и сколько открытых потоков держит один воркер (каждый занимает поток gthread)
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', '1'))
+EVENTS_KEEPALIVE = float(os.environ.get('EVENTS_KEEPALIVE', '15'))
+EVENTS_MAX_CLIENTS = int(os.environ.get('EVENTS_MAX_CLIENTS', '12'))
+
+# Групповая фиксация: добавления и удаления расходов воркера пишутся общими транзакциями
+# до GROUP_COMMIT_MAX_BATCH операций, первая операция ждёт не дольше GROUP_COMMIT_MAX_DELAY_MS
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'False').lower() == 'true'
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', '64'))
+GROUP_COMMIT_MAX_DELAY_MS = float(os.environ.get('GROUP_COMMIT_MAX_DELAY_MS', '5'))
+
+# Метрики: /metrics в формате Prometheus, по умолчанию выключены. METRICS_DIR — общий каталог, через который
+# суммируются данные всех воркеров gunicorn (без него /metrics показывает один воркер).
+# METRICS_TOKEN закрывает /metrics Bearer-токеном (без него эндпоинт открыт всем — задавайте его
+# вместе с METRICS_ENABLED), SLOW_QUERY_MS включает журнал медленных запросов.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False').lower() == 'true'
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))
+
+# Сжатие ответов (JSON, NDJSON, CSV, HTML) по Accept-Encoding: COMPRESSION_ENCODINGS задаёт порядок
+# предпочтения сервера (недоступные библиотеки пропускаются), тела меньше COMPRESSION_MIN_SIZE не сжимаются.
+# Если сжимает прокси перед gunicorn, выключите COMPRESSION.
+COMPRESSION = os.environ.get('COMPRESSION', 'True').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_ENCODINGS = [name for name in os.environ.get('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',')
+                         if name in compressor.available_encodings()] if COMPRESSION else []
+
+# Шардирование по пользователям: данные раскладываются по SHARD_COUNT файлам SQLite
+# (по умолчанию budget-shard0.db, … рядом с DATABASE или по шаблону SHARD_PATH_TEMPLATE вида
+# /data/shard{}.db), а DATABASE остаётся каталогом с таблицей user. 0 — всё в одном файле.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '0'))
+SHARD_PATH_TEMPLATE = os.environ.get('SHARD_PATH_TEMPLATE') or None
+SHARD_PATHS = shard_paths(DATABASE, SHARD_COUNT, SHARD_PATH_TEMPLATE)
+
+# Снимки баз (каталог и шарды) через sqlite3 backup API: BACKUP_DIR — куда класть .db.gz с .sha256,
+# BACKUP_KEEP — сколько последних снимков каждой базы хранить, BACKUP_INTERVAL — период фоновых снимков
+# в секундах (0 — только flask backup). Копия идёт порциями по BACKUP_STEP_PAGES страниц
+# с паузой BACKUP_STEP_SLEEP_MS, чтобы не задерживать запросы.
+BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'backups')
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', '7'))
+BACKUP_INTERVAL = float(os.environ.get('BACKUP_INTERVAL', '0'))
+BACKUP_STEP_PAGES = int(os.environ.get('BACKUP_STEP_PAGES', '256'))
+BACKUP_STEP_SLEEP_MS = float(os.environ.get('BACKUP_STEP_SLEEP_MS', '5'))
+
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 app.config['DEBUG'] = DEBUG
 
+metrics_registry = metrics.Metrics(METRICS_DIR)
+metrics_registry.remove_stale_files()
+
+def make_pool(path):
+    return ConnectionPool(
+        path,
+        size=DB_POOL_SIZE,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_CACHED_STATEMENTS,
+        pragmas=default_pragmas(SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE_KB, SQLITE_BUSY_TIMEOUT_MS),
+        factory=(metrics.connection_factory(metrics_registry, SLOW_QUERY_MS)
+                 if METRICS_ENABLED or SLOW_QUERY_MS > 0 else sqlite3.Connection),
+    )
+
+db_pool = make_pool(DATABASE)
+shard_router = ShardRouter(db_pool, [make_pool(path) for path in SHARD_PATHS])
+
 # Настройка Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+user_cache = UserCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+fragment_cache = FragmentCache(max_size=FRAGMENT_CACHE_SIZE)
+ledger_cache = LedgerCache(max_bytes=int(LEDGER_CACHE_MB * 1024 * 1024)) if LEDGER_CACHE_MB > 0 else None
+change_hub = ChangeHub(SHARD_PATHS or DATABASE, poll_interval=EVENTS_POLL_INTERVAL, max_clients=EVENTS_MAX_CLIENTS)
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, workers=HASH_WORKERS,
+                                 queue_size=HASH_QUEUE_SIZE, timeout=HASH_TIMEOUT)
+user_session_hits = 0
+backup_scheduler = (backup.BackupScheduler([DATABASE] + SHARD_PATHS, BACKUP_DIR, BACKUP_INTERVAL, keep=BACKUP_KEEP,
+                                           step_pages=BACKUP_STEP_PAGES, step_sleep=BACKUP_STEP_SLEEP_MS / 1000)
+                    if BACKUP_INTERVAL > 0 else None)
+
+def record_group_commit(writes, seconds):
+    metrics_registry.inc('budget_group_commit_batches_total')
+    metrics_registry.inc('budget_group_commit_writes_total', writes)
+    metrics_registry.observe('budget_group_commit_seconds', seconds)
+
+# Поток записи держит своё соединение до конца работы воркера (вне пула, чтобы все DB_POOL_SIZE
+# соединений остались потокам запросов); при шардах — по потоку на шард
+group_writers = ([GroupCommitWriter(pool.connect, max_batch=GROUP_COMMIT_MAX_BATCH,
+                                    max_delay=GROUP_COMMIT_MAX_DELAY_MS / 1000, on_commit=record_group_commit)
+                  for pool in shard_router.data_pools]
+                 if GROUP_COMMIT else None)
+
 # Класс User для Flask-Login
 class User(UserMixin):
     def __init__(self, id, username):
         self.id = id
         self.username = username
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
+# Соединение с каталогом (таблица user): одно из пула на запрос, возвращается в teardown
+def get_directory_connection():
+    if 'directory_db' not in g:
+        with metrics.phase('db_acquire'):
+            g.directory_db = db_pool.acquire()
+    return g.directory_db
+
+# Номер шарда пользователя (по умолчанию текущего); без шардов всегда 0
+def request_shard(user_id=None):
+    if not shard_router.sharded:
+        return 0
+    if 'db_shard' not in g:
+        g.db_shard = shard_router.locate(get_directory_connection(),
+                                         current_user.id if user_id is None else user_id)
+    return g.db_shard
+
+# Соединение с файлом, где лежат данные пользователя. Без шардов это тот же каталог.
+def get_db_connection(user_id=None):
+    if not shard_router.sharded:
+        return get_directory_connection()
+    if 'db' not in g:
+        pool = shard_router.shard_pools[request_shard(user_id)]
+        with metrics.phase('db_acquire'):
+            g.db = pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        shard_router.shard_pools[g.pop('db_shard')].release(conn)
+    conn = g.pop('directory_db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Данные пользователя переносятся в другой шард (flask rebalance-shards)
+@app.errorhandler(ShardMoving)
+def shard_moving(error):
+    return jsonify({'error': 'Данные переносятся, повторите запрос позже'}), 503, {'Retry-After': '5'}
+
+# Все соединения пула заняты дольше SQLITE_BUSY_TIMEOUT_MS: просим повторить, а не отвечаем 500
+@app.errorhandler(PoolTimeout)
+def pool_timeout(error):
+    return jsonify({'error': 'Сервер перегружен, повторите запрос позже'}), 503, {'Retry-After': '1'}
+
+# Поток снимков стартует при первом запросе воркера (после fork)
+@app.before_request
+def start_backup_scheduler():
+    if backup_scheduler is not None:
+        backup_scheduler.ensure_started()
+
+@app.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        g.request_started = time.perf_counter()
+        metrics.begin_request()
+        metrics_registry.start()
+
+# У потоковых ответов (выгрузки, SSE) время и размер фиксируются при закрытии,
+# то есть с учётом генерации всего тела; у остальных — сразу
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    route = request.endpoint or 'unmatched'
+    method = request.method
+    status = str(response.status_code)
+    sent = [0]
+    if response.is_streamed:
+        body = response.response
+        response.response = count_bytes(response.iter_encoded(), body, sent)
+    else:
+        sent[0] = response.calculate_content_length() or 0
+
+    def finish():
+        duration = time.perf_counter() - started
+        metrics_registry.inc('budget_http_requests_total', route=route, method=method, status=status)
+        metrics_registry.observe('budget_http_request_duration_seconds', duration, route=route, method=method)
+        metrics_registry.inc('budget_http_response_bytes_total', sent[0], route=route)
+        for name, seconds in metrics.end_request().items():
+            metrics_registry.observe('budget_request_phase_seconds', seconds, route=route, phase=name)
+
+    if response.is_streamed:
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+def count_bytes(chunks, body, sent):
+    try:
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+# Изменения из этого воркера сразу будят раздачу событий
+@app.after_request
+def wake_change_hub(response):
+    if request.method == 'POST' and response.status_code < 400:
+        change_hub.wake()
+    return response
+
+# Регистрируется последним, поэтому выполняется первым из after_request:
+# метрики считают уже сжатые байты
+@app.after_request
+def compress_response(response):
+    if (not COMPRESSION_ENCODINGS or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in compressor.COMPRESSIBLE_TYPES or response.status_code in (204, 304)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compressor.choose_encoding(request.accept_encodings, COMPRESSION_ENCODINGS)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        body = response.response
+        response.response = compressor.compress_stream(response.iter_encoded(), body, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        with metrics.phase('compress'):
+            response.set_data(compressor.compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое представление побайтно другое, поэтому ETag становится слабым. Маршруты сравнивают
+    # If-None-Match через contains_weak, так что 304 отдаются и для сжатых ответов.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Схема базы создаётся и обновляется миграциями (см. migrations.py)
 def init_db():
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        # 1. Создаем таблицу пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL
-            )
-        ''')
-        # 2. Обновляем таблицу расходов, добавляем user_id
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                description TEXT NOT NULL,
-                amount REAL NOT NULL,
-                date TEXT NOT NULL,
-                category TEXT,
-                user_id INTEGER NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES user (id)
-            )
-        ''')
-        # 3. Проверяем, есть ли пользователи. Если нет - создаем тестового.
-        cursor.execute('SELECT COUNT(*) FROM user')
-        user_count = cursor.fetchone()[0]
-        if user_count == 0:
-            hashed_password = generate_password_hash('password')
-            cursor.execute("INSERT INTO user (username, password_hash) VALUES (?, ?)",
-                           ('test_user', hashed_password))
-            user_id = cursor.lastrowid
-            # Добавляем тестовые расходы для этого пользователя
-            cursor.execute("INSERT INTO expenses (description, amount, date, category, user_id) VALUES (?, ?, ?, ?, ?)",
-                           ('Покупка продуктов', 5000, '2025-09-10', 'Еда', user_id))
-            cursor.execute("INSERT INTO expenses (description, amount, date, category, user_id) VALUES (?, ?, ?, ?, ?)",
-                           ('Такси', 1200, '2025-09-10', 'Транспорт', user_id))
-        conn.commit()
+    migrate(DATABASE)
+    for index, path in enumerate(SHARD_PATHS):
+        init_shard(path, index)
 
 # Flask-Login загружает пользователя по ID.
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM user WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    global user_session_hits
+    # Сессия подписана SECRET_KEY, поэтому имени из неё можно доверять
+    if USER_SESSION_AUTH and session.get('username') is not None:
+        user_session_hits += 1
+        return User(int(user_id), session['username'])
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    conn = get_directory_connection()
+    user = conn.execute('SELECT id, username FROM user WHERE id = ?', (user_id,)).fetchone()
     if user is not None:
-        return User(user['id'], user['username'])
+        user_obj = User(user['id'], user['username'])
+        user_cache.put(user_id, user_obj)
+        return user_obj
     return None
 
+# Вызывать при любом изменении записи пользователя
+def invalidate_user(user_id):
+    user_cache.invalidate(str(user_id))
+
+# Запись с фиксацией: через общий поток групповой фиксации или сразу в соединении запроса.
+# В обоих случаях к возврату из функции транзакция уже зафиксирована.
+def run_write(func, *args):
+    if group_writers is not None:
+        with metrics.phase('write_wait'):
+            return group_writers[request_shard()].submit(func, *args)
+    conn = get_db_connection()
+    result = func(conn, *args)
+    conn.commit()
+    return result
+
+# Пул хэширования переполнен: просим повторить позже, не занимая воркер
+def hashing_busy_response(template):
+    flash('Сервер перегружен, попробуйте ещё раз через несколько секунд.')
+    return render_template(template), 503, {'Retry-After': '1'}
+
 # Маршруты для аутентификации
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        conn = get_db_connection()
+        conn = get_directory_connection()
         user = conn.execute('SELECT * FROM user WHERE username = ?', (username,)).fetchone()
-        conn.close()
 
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            with metrics.phase('hashing'):
+                password_ok = user is not None and password_hasher.verify(user['password_hash'], password)
+        except HashingBusy:
+            return hashing_busy_response('login.html')
+
+        if password_ok:
+            # Старые хэши прозрачно пересчитываются с текущими параметрами
+            if password_hasher.needs_rehash(user['password_hash']):
+                try:
+                    with metrics.phase('hashing'):
+                        new_hash = password_hasher.hash(password)
+                    conn.execute('UPDATE user SET password_hash = ? WHERE id = ?', (new_hash, user['id']))
+                    conn.commit()
+                    invalidate_user(user['id'])
+                except HashingBusy:
+                    pass
             user_obj = User(user['id'], user['username'])
             login_user(user_obj)
+            if USER_SESSION_AUTH:
+                session['username'] = user['username']
             return redirect(url_for('index'))
         else:
             flash('Неверное имя пользователя или пароль.')
@@ -109,6 +401,7 @@ def login():
 @login_required
 def logout():
     logout_user()
+    session.pop('username', None)
     return redirect(url_for('index'))
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -116,19 +409,27 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        conn = get_db_connection()
+        conn = get_directory_connection()
+        # Занятое имя проверяем до дорогого хэширования
+        if conn.execute('SELECT 1 FROM user WHERE username = ?', (username,)).fetchone():
+            flash('Это имя пользователя уже занято.')
+            return render_template('register.html')
 
         try:
-            hashed_password = generate_password_hash(password)
-            conn.execute('INSERT INTO user (username, password_hash) VALUES (?, ?)',
-                         (username, hashed_password))
+            with metrics.phase('hashing'):
+                hashed_password = password_hasher.hash(password)
+        except HashingBusy:
+            return hashing_busy_response('register.html')
+        try:
+            cursor = conn.execute('INSERT INTO user (username, password_hash) VALUES (?, ?)',
+                                  (username, hashed_password))
+            if shard_router.sharded:
+                shard_router.assign(conn, cursor.lastrowid)
             conn.commit()
             flash('Регистрация прошла успешно! Теперь вы можете войти.')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             flash('Это имя пользователя уже занято.')
-        finally:
-            conn.close()
 
     return render_template('register.html')
 
@@ -136,32 +437,497 @@ def register():
 @app.route('/')
 def index():
     # Главная страница, перенаправит на логин если пользователь не авторизован
-    return render_template('index.html')
+    if not current_user.is_authenticated:
+        return render_template('index.html')
+    # Первая страница расходов и сумма приходят вместе с HTML, скрипту остаётся только
+    # подхватить курсор и номер журнала. Фрагмент живёт до следующего изменения данных.
+    conn = get_db_connection()
+    version = storage.get_data_version(conn, current_user.id)
+    fragment = fragment_cache.get(current_user.id, version)
+    if fragment is None:
+        with metrics.phase('render'):
+            fragment = render_first_page(conn)
+        fragment_cache.put(current_user.id, version, fragment)
+    return render_template('index.html', **fragment)
+
+def render_first_page(conn):
+    # Номер журнала — до чтения списка, как в script.js: изменения между ними клиент дочитает
+    last_seq = storage.get_last_change_seq(conn, current_user.id)
+    filters = storage.parse_expense_filters({})
+    expenses, next_cursor = fetch_expense_page(conn, filters)
+    rows = render_template('expense_rows.html',
+                           expenses=[dict(zip(storage.EXPENSE_FIELDS, row)) for row in expenses])
+    return {
+        'expense_rows': Markup(rows),
+        'total': f'{storage.fetch_total_cents(conn, current_user.id) / 100:.2f}',
+        'initial_state': {'sort': filters['sort'], 'next_cursor': next_cursor, 'last_seq': last_seq},
+    }
+
+# Условный GET: ETag строится из версии данных пользователя и параметров запроса,
+# поэтому на If-None-Match отвечаем 304 без обращения к таблице expenses
+def data_etag(conn, extra=''):
+    version = storage.get_data_version(conn, current_user.id)
+    key = f'{request.endpoint}:{current_user.id}:{version}:{extra}:'.encode() + request.query_string
+    return hashlib.sha1(key).hexdigest()[:20]
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Журнал текущего пользователя из колоночного кэша воркера; None — читать из SQL
+def user_ledger(conn):
+    if ledger_cache is None:
+        return None
+    with metrics.phase('ledger'):
+        return ledger_cache.get(conn, current_user.id)
+
+def fetch_expense_page(conn, filters):
+    # Журнал держит только неархивные расходы: годится, если диапазон не задевает архив
+    # или страница «новые сначала» целиком набрана из строк не старше границы архива
+    archives = storage.archives_for(conn, filters)
+    if archives and storage.SORTS[filters['sort']] != ('date', 'DESC'):
+        return storage.fetch_expense_page(conn, current_user.id, filters)
+    ledger = user_ledger(conn)
+    if ledger is not None:
+        try:
+            with metrics.phase('ledger'):
+                rows, next_cursor = ledger.page(filters)
+        except ValueError:
+            # Курсор с датой не в ISO: такой запрос обслужит SQL
+            pass
+        else:
+            if not archives or (next_cursor and rows[-1][3] >= max(before for _, before in archives)):
+                return rows, next_cursor
+    return storage.fetch_expense_page(conn, current_user.id, filters)
 
 @app.route('/expenses')
 @login_required  # Только для вошедших пользователей!
 def get_expenses():
+    # Параметры: date_from, date_to, category, sort (date, -date, amount, -amount), limit, cursor,
+    # format (records — список объектов, columnar — {"id": [...], "amount": [...], ...})
+    try:
+        filters = storage.parse_expense_filters(request.args)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
     # ВАЖНО: возвращаем только расходы текущего пользователя!
     conn = get_db_connection()
-    expenses = conn.execute('SELECT * FROM expenses WHERE user_id = ?', (current_user.id,)).fetchall()
-    conn.close()
-    expenses_list = [dict(expense) for expense in expenses]
-    return jsonify(expenses_list)
+    etag = data_etag(conn)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    expenses, next_cursor = fetch_expense_page(conn, filters)
+    with metrics.phase('serialize'):
+        body = serialization.encode_rows(storage.EXPENSE_FIELDS, expenses, filters['format'], next_cursor=next_cursor)
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+@app.route('/summary')
+@login_required
+def get_summary():
+    # Необязательные параметры month_from и month_to в формате YYYY-MM
+    try:
+        month_from = storage.parse_month(request.args['month_from']) if request.args.get('month_from') else None
+        month_to = storage.parse_month(request.args['month_to']) if request.args.get('month_to') else None
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    conn = get_db_connection()
+    etag = data_etag(conn)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    summary = storage.fetch_summary(conn, current_user.id, month_from, month_to)
+    return with_etag(jsonify(summary), etag)
+
+# Полнотекстовый поиск: /expenses/search?q=такси&limit=50&offset=0, порядок — storage.search_expenses
+@app.route('/expenses/search')
+@login_required
+def search_expenses():
+    try:
+        limit = int(request.args.get('limit', storage.DEFAULT_LIMIT))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit и offset должны быть числами'}), 400
+    if not 1 <= limit <= storage.MAX_LIMIT or offset < 0:
+        return jsonify({'error': f'limit должен быть от 1 до {storage.MAX_LIMIT}, offset — не меньше 0'}), 400
+    conn = get_db_connection()
+    etag = data_etag(conn)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    try:
+        expenses, next_offset = storage.search_expenses(conn, current_user.id, request.args.get('q', ''),
+                                                        limit, offset)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    with metrics.phase('serialize'):
+        body = serialization.encode_rows(storage.EXPENSE_FIELDS, expenses, request.args.get('format', 'records'),
+                                         next_offset=next_offset)
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+# Дельта-синхронизация: изменения после since (номер из журнала).
+# Без since возвращает только last_seq — с него клиент начинает следить за изменениями.
+@app.route('/expenses/changes')
+@login_required
+def get_expense_changes():
+    conn = get_db_connection()
+    if not request.args.get('since'):
+        return jsonify({'reset': False, 'changes': [], 'has_more': False,
+                        'last_seq': storage.get_last_change_seq(conn, current_user.id)})
+    try:
+        since = int(request.args['since'])
+        limit = int(request.args.get('limit', storage.MAX_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'since и limit должны быть числами'}), 400
+    limit = max(1, min(limit, storage.MAX_LIMIT))
+    return jsonify(storage.fetch_changes(conn, current_user.id, since, limit))
+
+# Поток уведомлений об изменениях расходов текущего пользователя.
+# Нужен поточный воркер: gunicorn --worker-class gthread (см. Procfile).
+@app.route('/events')
+@login_required
+def events():
+    user_id = current_user.id
+    subscription = change_hub.subscribe(user_id)
+    if subscription is None:
+        return jsonify({'error': 'Слишком много открытых подключений'}), 503, {'Retry-After': '30'}
+
+    # Без stream_with_context: соединение с БД вернётся в пул сразу, а не после закрытия потока
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    message = subscription.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_event(message)
+        finally:
+            change_hub.unsubscribe(user_id, subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Выгрузка с теми же фильтрами, что и /expenses (limit и cursor не нужны)
+def export_filters():
+    args = request.args.to_dict()
+    args.pop('limit', None)
+    return storage.parse_expense_filters(args)
+
+@app.route('/expenses/export.csv')
+@login_required
+def export_expenses_csv():
+    try:
+        filters = export_filters()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    conn = get_db_connection()
+    rows = storage.iter_expenses(conn, current_user.id, filters)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM нужен Excel, чтобы правильно показать кириллицу
+        buffer.write('\ufeff')
+        writer.writerow(['id', 'date', 'amount', 'category', 'description'])
+        for count, (expense_id, description, amount, date, category, _) in enumerate(rows, start=1):
+            writer.writerow([expense_id, date, f'{amount:.2f}', category or '', description])
+            if count % 1000 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=expenses.csv'})
+
+@app.route('/expenses/export.ndjson')
+@login_required
+def export_expenses_ndjson():
+    try:
+        filters = export_filters()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    conn = get_db_connection()
+    rows = storage.iter_expenses(conn, current_user.id, filters)
+
+    def generate():
+        lines = []
+        for row in rows:
+            lines.append(serialization.dumps(dict(zip(storage.EXPENSE_FIELDS, row))))
+            if len(lines) == 1000:
+                yield b'\n'.join(lines) + b'\n'
+                lines.clear()
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=expenses.ndjson'})
+
+# Пакет изменений одним запросом и одной транзакцией:
+# {"create": [{description, amount, date, category}], "update": [{id, ...поля}], "delete": [id, ...]}
+@app.route('/api/expenses/batch', methods=['POST'])
+@login_required
+def batch_expenses():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    creates, updates, deletes = payload.get('create', []), payload.get('update', []), payload.get('delete', [])
+    if not all(isinstance(items, list) for items in (creates, updates, deletes)):
+        return jsonify({'error': 'create, update и delete должны быть списками'}), 400
+    if len(creates) + len(updates) + len(deletes) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Не больше {BATCH_MAX_ITEMS} операций в пакете'}), 413
+
+    # Сначала проверяем весь пакет: при любой ошибке ничего не меняется
+    errors = []
+    parsed_creates, parsed_updates = [], []
+    for index, item in enumerate(creates):
+        try:
+            parsed_creates.append(storage.parse_expense_fields(item))
+        except ValueError as error:
+            errors.append({'op': 'create', 'index': index, 'error': str(error)})
+    for index, item in enumerate(updates):
+        try:
+            # bool — подкласс int: JSON true не должен превращаться в id 1
+            if not isinstance(item, dict) or not isinstance(item.get('id'), int) or isinstance(item['id'], bool):
+                raise ValueError('Нужен числовой id')
+            parsed_updates.append((item['id'], storage.parse_expense_fields(item, partial=True)))
+        except ValueError as error:
+            errors.append({'op': 'update', 'index': index, 'error': str(error)})
+    for index, expense_id in enumerate(deletes):
+        if not isinstance(expense_id, int) or isinstance(expense_id, bool):
+            errors.append({'op': 'delete', 'index': index, 'error': 'Нужен числовой id'})
+    if errors:
+        return jsonify({'error': 'Пакет не применён', 'errors': errors}), 400
+
+    conn = get_db_connection()
+    try:
+        result = storage.apply_batch(conn, current_user.id, parsed_creates, parsed_updates, deletes)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return jsonify(result)
+
+# Доходы, регулярные операции и бюджеты: GET — список, POST — новая запись (JSON), DELETE /<id>
+def planning_list(key, fields, rows):
+    body = serialization.encode_rows(fields, rows, request.args.get('format', 'records'), key=key)
+    return Response(body, mimetype='application/json')
+
+def planning_create(parse, insert):
+    try:
+        fields = parse(request.get_json(silent=True))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    conn = get_db_connection()
+    record_id = insert(conn, current_user.id, fields)
+    conn.commit()
+    return jsonify({'id': record_id}), 201
+
+def planning_delete(delete, record_id):
+    conn = get_db_connection()
+    if not delete(conn, current_user.id, record_id):
+        return jsonify({'error': 'Запись не найдена'}), 404
+    conn.commit()
+    return jsonify({'deleted': record_id})
+
+@app.route('/api/income', methods=['GET', 'POST'])
+@login_required
+def income_collection():
+    if request.method == 'POST':
+        return planning_create(planning.parse_income_fields, planning.insert_income)
+    try:
+        date_from = storage.normalize_date(request.args['date_from']) if request.args.get('date_from') else None
+        date_to = storage.normalize_date(request.args['date_to']) if request.args.get('date_to') else None
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    rows = planning.fetch_income(get_db_connection(), current_user.id, date_from, date_to)
+    return planning_list('income', planning.INCOME_FIELDS, rows)
+
+@app.route('/api/income/<int:income_id>', methods=['DELETE'])
+@login_required
+def income_item(income_id):
+    return planning_delete(planning.delete_income, income_id)
+
+@app.route('/api/recurring', methods=['GET', 'POST'])
+@login_required
+def recurring_collection():
+    if request.method == 'POST':
+        return planning_create(planning.parse_recurring_fields, planning.insert_recurring)
+    rows = planning.fetch_recurring(get_db_connection(), current_user.id)
+    return planning_list('recurring', planning.RECURRING_FIELDS, rows)
+
+@app.route('/api/recurring/<int:rule_id>', methods=['DELETE'])
+@login_required
+def recurring_item(rule_id):
+    return planning_delete(planning.delete_recurring, rule_id)
+
+@app.route('/api/budgets', methods=['GET', 'POST'])
+@login_required
+def budget_collection():
+    if request.method == 'POST':
+        return planning_create(planning.parse_budget_fields, planning.upsert_budget)
+    rows = planning.fetch_budgets(get_db_connection(), current_user.id)
+    return planning_list('budgets', planning.BUDGET_FIELDS, rows)
+
+@app.route('/api/budgets/<int:budget_id>', methods=['DELETE'])
+@login_required
+def budget_item(budget_id):
+    return planning_delete(planning.delete_budget, budget_id)
+
+# Прогноз баланса по дням: /forecast?years=10&resolution=month&budgets=1&start=2025-01-01
+# (вместо years можно days; по умолчанию — год вперёд от сегодняшнего дня)
+@app.route('/forecast')
+@login_required
+def get_forecast():
+    try:
+        start = storage.normalize_date(request.args['start']) if request.args.get('start') else date_type.today().isoformat()
+        if request.args.get('days'):
+            days = int(request.args['days'])
+        else:
+            # inf, nan и слишком большие years не превращаются в целое число дней
+            days = float(request.args.get('years', 1)) * 365.25
+            if not math.isfinite(days):
+                raise ValueError('years должен быть конечным числом')
+            days = round(days)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    resolution = request.args.get('resolution', 'day')
+    if not 1 <= days <= forecast.MAX_DAYS:
+        return jsonify({'error': f'Горизонт прогноза — от 1 до {forecast.MAX_DAYS} дней'}), 400
+    if resolution not in forecast.RESOLUTIONS:
+        return jsonify({'error': f'resolution должен быть одним из: {", ".join(forecast.RESOLUTIONS)}'}), 400
+    conn = get_db_connection()
+    # Без start прогноз зависит от текущей даты, поэтому она входит в ETag
+    etag = data_etag(conn, start)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    end = (date_type.fromisoformat(start) + timedelta(days=days - 1)).isoformat()
+    inputs = planning.fetch_forecast_inputs(conn, current_user.id, start, end)
+    with metrics.phase('forecast'):
+        result = forecast.project(inputs, start, days, resolution, request.args.get('budgets', '1') != '0')
+    with metrics.phase('serialize'):
+        body = serialization.dumps(result)
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+# Баланс (доходы минус расходы) по дереву Фенвика: каждый ответ — O(log n) узлов
+HISTORY_STEPS = {'day': 1, 'week': 7}
+MAX_HISTORY_POINTS = 3660
+
+def date_arg(name, default=None):
+    value = request.args.get(name)
+    return storage.normalize_date(value) if value else default
+
+@app.route('/balance')
+@login_required
+def get_balance():
+    try:
+        day = date_arg('date', date_type.today().isoformat())
+        amount = balance.balance_as_of(get_db_connection(), current_user.id, day)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify({'date': day, 'balance': amount / 100})
+
+# Доходы минус расходы за период [date_from, date_to]
+@app.route('/balance/range')
+@login_required
+def get_balance_range():
+    try:
+        date_from, date_to = date_arg('date_from'), date_arg('date_to')
+        if not date_from or not date_to:
+            raise ValueError('Нужны date_from и date_to')
+        if date_from > date_to:
+            raise ValueError('date_from позже date_to')
+        net = balance.balance_between(get_db_connection(), current_user.id, date_from, date_to)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify({'date_from': date_from, 'date_to': date_to, 'net': net / 100})
+
+# Баланс на конец каждого дня, недели или месяца периода: /balance/history?date_from=...&step=month
+@app.route('/balance/history')
+@login_required
+def get_balance_history():
+    step = request.args.get('step', 'day')
+    try:
+        date_to = date_arg('date_to', date_type.today().isoformat())
+        date_from = date_arg('date_from', (date_type.fromisoformat(date_to) - timedelta(days=29)).isoformat())
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    if step not in ('day', 'week', 'month'):
+        return jsonify({'error': 'step должен быть day, week или month'}), 400
+    first, last = date_type.fromisoformat(date_from), date_type.fromisoformat(date_to)
+    if first > last:
+        return jsonify({'error': 'date_from позже date_to'}), 400
+    # Точка — последний день шага (месяца, недели) внутри периода
+    days = []
+    if step == 'month':
+        month = first.replace(day=1)
+        while month <= last and len(days) <= MAX_HISTORY_POINTS:
+            following = (month + timedelta(days=32)).replace(day=1)
+            days.append(min(following - timedelta(days=1), last).isoformat())
+            month = following
+    else:
+        day = first + timedelta(days=HISTORY_STEPS[step] - 1)
+        while day <= last and len(days) <= MAX_HISTORY_POINTS:
+            days.append(day.isoformat())
+            day += timedelta(days=HISTORY_STEPS[step])
+        if not days or days[-1] != date_to:
+            days.append(date_to)
+    if len(days) > MAX_HISTORY_POINTS:
+        return jsonify({'error': f'Не больше {MAX_HISTORY_POINTS} точек, увеличьте step'}), 400
+    conn = get_db_connection()
+    etag = data_etag(conn, date_to)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    try:
+        values = balance.balance_history(conn, current_user.id, days)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    body = serialization.dumps({'step': step, 'dates': days, 'balance': [value / 100 for value in values]})
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+# Служебная статистика кэшей воркера
+@app.route('/stats')
+@login_required
+def get_stats():
+    return jsonify({
+        'user_cache': dict(user_cache.stats(), session_hits=user_session_hits),
+        'ledger_cache': ledger_cache.stats() if ledger_cache is not None else None,
+        'fragment_cache': fragment_cache.stats(),
+        'group_commit': [writer.stats() for writer in group_writers] if group_writers is not None else None,
+    })
+
+# Метрики всех воркеров в текстовом формате Prometheus
+@app.route('/metrics')
+def get_metrics():
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Метрики отключены'}), 404
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Нужен токен'}), 401
+    metrics_registry.flush()
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/add', methods=('GET', 'POST'))
 @login_required
 def add_expense():
     if request.method == 'POST':
         description = request.form['description']
-        amount = float(request.form['amount'])
-        date = request.form['date']
         category = request.form.get('category', '')
-        conn = get_db_connection()
+        try:
+            amount_cents = storage.parse_amount_cents(request.form['amount'])
+            date = storage.normalize_date(request.form['date'])
+        except ValueError as error:
+            flash(str(error))
+            return render_template('add_expense.html'), 400
         # ВАЖНО: добавляем расход с ID текущего пользователя!
-        conn.execute('INSERT INTO expenses (description, amount, date, category, user_id) VALUES (?, ?, ?, ?, ?)',
-                     (description, amount, date, category, current_user.id))
-        conn.commit()
-        conn.close()
+        try:
+            run_write(storage.insert_expense, current_user.id, description, amount_cents, date, category)
+        except WriterBusy:
+            flash('Сервер перегружен, попробуйте ещё раз через несколько секунд.')
+            return render_template('add_expense.html'), 503, {'Retry-After': '1'}
         return redirect(url_for('index'))
     return render_template('add_expense.html')
 
@@ -169,14 +935,195 @@ def add_expense():
 @login_required
 def delete_expense(expense_id):
     # ВАЖНО: удаляем только если расход принадлежит текущему пользователю!
-    conn = get_db_connection()
-    conn.execute('DELETE FROM expenses WHERE id=? AND user_id=?', (expense_id, current_user.id))
-    conn.commit()
-    conn.close()
+    try:
+        run_write(storage.delete_expense, current_user.id, expense_id)
+    except WriterBusy:
+        # Форма на главной: как и /add, сообщаем о перегрузке на странице, а не JSON-ом
+        flash('Сервер перегружен, попробуйте ещё раз через несколько секунд.')
     return redirect(url_for('index'))
 
+# Импорт выписки CSV/OFX; файл читается потоком, строки пишутся пачками
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_expenses():
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        wants_json = request.accept_mimetypes.best == 'application/json'
+        if upload is None or not upload.filename:
+            if wants_json:
+                return jsonify({'error': 'Файл не выбран'}), 400
+            flash('Файл не выбран')
+            return render_template('import.html'), 400
+        file_format = request.form.get('format') or importer.detect_format(upload.filename)
+        conn = get_db_connection()
+        try:
+            report = importer.import_file(conn, current_user.id, upload.stream, file_format,
+                                          chunk_size=IMPORT_CHUNK_SIZE)
+        except importer.ImportFormatError as error:
+            if wants_json:
+                return jsonify({'error': str(error)}), 400
+            flash(str(error))
+            return render_template('import.html'), 400
+        # Файл перестал читаться после зафиксированных пачек: показываем, что уже импортировано
+        status = 400 if report['stopped'] else 200
+        if wants_json:
+            return jsonify(report), status
+        if report['stopped']:
+            flash(f"Импорт остановлен: {report['stopped']['error']}. "
+                  f"Строки до {report['stopped']['line']} импортированы ({report['imported']}).")
+        return render_template('import.html', report=report), status
+    return render_template('import.html')
+
+# Импорт из командной строки: flask --app app import-expenses выписка.csv --user test_user
+@app.cli.command('import-expenses')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='Имя пользователя, которому добавить расходы')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ofx']), default=None)
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True)
+def import_expenses_command(path, username, file_format, chunk_size):
+    user = get_directory_connection().execute('SELECT id FROM user WHERE username = ?', (username,)).fetchone()
+    if user is None:
+        raise click.ClickException(f'Пользователь {username} не найден')
+    conn = get_db_connection(user['id'])
+    with open(path, 'rb') as stream:
+        try:
+            report = importer.import_file(conn, user['id'], stream, file_format or importer.detect_format(path),
+                                          chunk_size=chunk_size)
+        except importer.ImportFormatError as error:
+            raise click.ClickException(str(error))
+    print(f"Импортировано: {report['imported']}, пропущено: {report['skipped']}, ошибок: {report['failed']}")
+    print(f"Время: {report['elapsed_seconds']} с, {report['rows_per_second']} строк/с")
+    for error in report['errors']:
+        print(f"  строка {error['line']}: {error['error']}")
+    if report['stopped']:
+        raise click.ClickException(f"Импорт остановлен на строке {report['stopped']['line']}: "
+                                   f"{report['stopped']['error']}; строки до неё импортированы")
+
+# Пересчёт помесячных итогов: flask --app app rebuild-rollups
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    for pool in shard_router.data_pools:
+        conn = pool.acquire()
+        try:
+            storage.rebuild_rollups(conn)
+            conn.commit()
+            count = conn.execute('SELECT COUNT(*) FROM expense_rollup').fetchone()[0]
+        finally:
+            pool.release(conn)
+        print(f'{pool.path}: итоги пересчитаны, {count} строк')
+
+# Сжатие журнала изменений: flask --app app compact-changes --keep-days 30
+@app.cli.command('compact-changes')
+@click.option('--keep-days', default=30, show_default=True, help='Сколько дней хранить записи журнала')
+def compact_changes_command(keep_days):
+    for pool in shard_router.data_pools:
+        conn = pool.acquire()
+        try:
+            deduplicated, expired = storage.compact_changes(conn, keep_days)
+            conn.commit()
+        finally:
+            pool.release(conn)
+        print(f'{pool.path}: удалено повторных записей: {deduplicated}, устаревших: {expired}')
+
+# Перенос старых расходов в архивные таблицы по годам (в каждом файле с данными):
+# flask --app app archive-expenses --keep-days 730 или --before 2024-01-01.
+# Итоги и баланс не меняются, списки и отчёты читают архив, только если диапазон дат его задевает.
+@app.cli.command('archive-expenses')
+@click.option('--before', help='Архивировать расходы с датой раньше этой (YYYY-MM-DD)')
+@click.option('--keep-days', type=int, default=ARCHIVE_KEEP_DAYS, show_default=True,
+              help='Сколько последних дней оставить в основной таблице (если --before не задан)')
+def archive_expenses_command(before, keep_days):
+    if before:
+        try:
+            before = storage.normalize_date(before)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    else:
+        before = (date_type.today() - timedelta(days=keep_days)).isoformat()
+    for pool in shard_router.data_pools:
+        conn = pool.acquire()
+        try:
+            # Каждый год — отдельная транзакция, чтобы не держать блокировку записи надолго
+            for year in archive.archivable_years(conn, before):
+                moved, users = storage.archive_expenses_year(conn, year, before)
+                conn.commit()
+                print(f'{pool.path}: {year}: перенесено {moved} строк, пользователей: {users}')
+            for year, archived_before, rows in archive.archive_status(conn):
+                print(f'{pool.path}: архив {year} (до {archived_before}): {rows} строк')
+        finally:
+            pool.release(conn)
+
+# Онлайн-снимок каталога и шардов: flask --app app backup [--dir backups] [--keep 7].
+# Запросы и записи во время снимка продолжают работать; проверка: sha256sum -c <снимок>.sha256
+@app.cli.command('backup')
+@click.option('--dir', 'directory', default=BACKUP_DIR, show_default=True, help='Каталог снимков')
+@click.option('--keep', type=int, default=BACKUP_KEEP, show_default=True, help='Сколько снимков каждой базы хранить')
+@click.option('--step-pages', type=int, default=BACKUP_STEP_PAGES, show_default=True,
+              help='Страниц за один шаг копирования')
+@click.option('--step-sleep-ms', type=float, default=BACKUP_STEP_SLEEP_MS, show_default=True,
+              help='Пауза между шагами')
+def backup_command(directory, keep, step_pages, step_sleep_ms):
+    results = backup.backup_all([DATABASE] + SHARD_PATHS, directory, keep, step_pages, step_sleep_ms / 1000)
+    if results is None:
+        raise click.ClickException(f'Снимок уже делается (блокировка в {directory})')
+    for result in results:
+        print(f'{result["database"]} -> {result["snapshot"]}')
+        print(f'  страниц: {result["pages"]}, шагов: {result["steps"]}, повторов: {result["restarts"]}, '
+              f'копия {result["copy_seconds"]} с, всего {result["seconds"]} с')
+        print(f'  {result["bytes"]} -> {result["compressed_bytes"]} байт, sha256 {result["sha256"]}')
+        if result['removed']:
+            print(f'  удалены старые снимки: {", ".join(result["removed"])}')
+
+def require_shards():
+    if not shard_router.sharded:
+        raise click.ClickException('Шарды не настроены: задайте SHARD_COUNT')
+
+# Перенос пользователей из общей базы в шарды: SHARD_COUNT=4 flask --app app split-shards.
+# Неразмещённый пользователь переносится и сам при первом запросе, команда делает это заранее.
+@app.cli.command('split-shards')
+def split_shards_command():
+    require_shards()
+    placed = shard_router.split(get_directory_connection())
+    counts = {}
+    for shard in placed.values():
+        counts[shard] = counts.get(shard, 0) + 1
+    print(f'Размещено пользователей: {len(placed)}')
+    for shard in sorted(counts):
+        print(f'  шард {shard}: {counts[shard]}')
+
+# Пользователи и расходы по шардам
+@app.cli.command('shard-status')
+def shard_status_command():
+    require_shards()
+    loads = shard_router.loads(get_directory_connection())
+    for index, (path, shard_load) in enumerate(zip(SHARD_PATHS, loads)):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        print(f'шард {index}: пользователей {len(shard_load)}, расходов {sum(shard_load.values())}, '
+              f'{size / 1024 / 1024:.1f} МБ ({path})')
+
+# Выравнивание шардов по числу расходов, например после увеличения SHARD_COUNT:
+# flask --app app rebalance-shards --dry-run
+@app.cli.command('rebalance-shards')
+@click.option('--tolerance', default=0.1, show_default=True, help='Допустимый разрыв относительно средней нагрузки')
+@click.option('--grace', default=5.0, show_default=True, help='Секунд ожидания запросов перед переносом пользователя')
+@click.option('--max-moves', default=1000, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Только показать план')
+def rebalance_shards_command(tolerance, grace, max_moves, dry_run):
+    require_shards()
+    loads = shard_router.loads(get_directory_connection())
+    moves = shard_router.plan_rebalance(loads, tolerance, max_moves)
+    print(f'Расходов по шардам: {[sum(shard_load.values()) for shard_load in loads]}, переносов: {len(moves)}')
+    for user_id, source, target, rows in moves:
+        print(f'  пользователь {user_id}: шард {source} -> {target}, {rows} расходов')
+        if not dry_run:
+            started = time.perf_counter()
+            shard_router.move(user_id, target, grace)
+            print(f'    перенесён за {time.perf_counter() - started - grace:.2f} с')
+
+# Миграции выполняются при импорте, то есть и под gunicorn, и при запуске напрямую
+init_db()
+
 if __name__ == '__main__':
-    init_db()
     app.run(debug=True)
 
 
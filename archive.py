@@ -0,0 +1,158 @@
+import sqlite3
+
+# Холодные расходы: строки старше горизонта архивации переносятся из expenses в таблицы
+# expenses_archive_<год> того же файла. Итоги (expense_rollup) и индекс баланса
+# (balance_fenwick) считают все строки и при переносе не меняются. В expense_archive
+# для каждого года записана граница archived_before: строк года с датой меньше неё
+# в expenses нет (кроме внесённых задним числом после архивации).
+# Полнотекстовый индекс архива — отдельная FTS5-таблица без содержимого (expenses_archive_fts):
+# текст лежит в архивных таблицах, индекс пополняется при архивации.
+ARCHIVE_COLUMNS = 'id, description, amount_cents, date, category, user_id'
+ISO_DATE_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+
+
+def archive_table(year):
+    return f'expenses_archive_{int(year):04d}'
+
+
+# [(год, archived_before)] по возрастанию года; до миграции реестра — пусто
+def archived_years(conn):
+    try:
+        return conn.execute('SELECT year, archived_before FROM expense_archive ORDER BY year').fetchall()
+    except sqlite3.OperationalError:
+        return []
+
+
+def archive_tables(conn):
+    return [archive_table(year) for year, _ in archived_years(conn)]
+
+
+# Архивные таблицы, в которых могут быть строки с датой из [date_from, date_to]:
+# [(таблица, archived_before)]. Если date_from не раньше границы года, год не нужен.
+def tables_for_range(conn, date_from=None, date_to=None):
+    tables = []
+    for year, archived_before in archived_years(conn):
+        if date_from and (date_from >= archived_before or int(date_from[:4]) > year):
+            continue
+        if date_to and int(date_to[:4]) < year:
+            continue
+        tables.append((archive_table(year), archived_before))
+    return tables
+
+
+# Источник строк для отчётных запросов: expenses или объединение с нужными архивами
+def expense_source(conn, date_from=None, date_to=None):
+    tables = ['expenses'] + [table for table, _ in tables_for_range(conn, date_from, date_to)]
+    if len(tables) == 1:
+        return 'expenses'
+    return '(' + ' UNION ALL '.join(f'SELECT {ARCHIVE_COLUMNS} FROM {table}' for table in tables) + ')'
+
+
+def ensure_archive_table(conn, year):
+    table = archive_table(year)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            category TEXT,
+            user_id INTEGER NOT NULL
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_date ON {table} (user_id, date, amount_cents)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_amount ON {table} (user_id, amount_cents)')
+    return table
+
+
+# Годы, в которых есть строки старше before (даты не в ISO не трогаем)
+def archivable_years(conn, before):
+    rows = conn.execute(f'SELECT DISTINCT CAST(substr(date, 1, 4) AS INTEGER) FROM expenses '
+                        f"WHERE date < ? AND date GLOB '{ISO_DATE_GLOB}' ORDER BY 1", (before,)).fetchall()
+    return [row[0] for row in rows]
+
+
+# Переносит строки года с датой меньше before в архив (commit не делает).
+# Возвращает число строк и пользователей, чьи данные переехали.
+def archive_year(conn, year, before):
+    table = ensure_archive_table(conn, year)
+    lower, upper = f'{year:04d}-01-01', min(before, f'{year + 1:04d}-01-01')
+    users = [row[0] for row in conn.execute('SELECT DISTINCT user_id FROM expenses WHERE date >= ? AND date < ?',
+                                            (lower, upper)).fetchall()]
+    moved = conn.execute(f'INSERT INTO {table} ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM expenses '
+                         f'WHERE date >= ? AND date < ?', (lower, upper)).rowcount
+    # Из expenses_fts строки уйдут триггером при удалении, в поиске их заменит индекс архива
+    conn.execute('INSERT INTO expenses_archive_fts (rowid, description, category, user_id) '
+                 'SELECT id, description, category, user_id FROM expenses WHERE date >= ? AND date < ?',
+                 (lower, upper))
+    conn.execute('DELETE FROM expenses WHERE date >= ? AND date < ?', (lower, upper))
+    conn.execute('''
+        INSERT INTO expense_archive (year, archived_before) VALUES (?, ?)
+        ON CONFLICT (year) DO UPDATE SET archived_before = MAX(archived_before, excluded.archived_before)
+    ''', (year, upper))
+    return moved, users
+
+
+# Возвращает архивную строку в expenses (с тем же id) перед изменением или удалением
+def restore_expense(conn, user_id, expense_id):
+    for table in archive_tables(conn):
+        row = conn.execute(f'DELETE FROM {table} WHERE id = ? AND user_id = ? RETURNING {ARCHIVE_COLUMNS}',
+                           (expense_id, user_id)).fetchone()
+        if row is not None:
+            _unindex(conn, [(row[0], row[1], row[4], row[5])])
+            conn.execute(f'INSERT INTO expenses ({ARCHIVE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)', tuple(row))
+            return True
+    return False
+
+
+# Индекс без содержимого удаляет строку только по её исходным значениям
+def _unindex(conn, rows):
+    conn.executemany("INSERT INTO expenses_archive_fts (expenses_archive_fts, rowid, description, category, user_id) "
+                     "VALUES ('delete', ?, ?, ?, ?)", rows)
+
+
+# Удаляет архивные расходы пользователя вместе с их записями в индексе поиска
+def delete_user_archive(conn, user_id):
+    for table in archive_tables(conn):
+        rows = conn.execute(f'SELECT id, description, category, user_id FROM {table} WHERE user_id = ?',
+                            (user_id,)).fetchall()
+        _unindex(conn, [tuple(row) for row in rows])
+        conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+
+
+# Поиск по архиву: match — запрос FTS5 (storage.build_search_query). Строки в порядке
+# EXPENSE_FIELDS от новых к старым: без ранжирования запрос читает из индекса только
+# offset + limit строк
+def search_archived(conn, match, limit, offset=0):
+    tables = archive_tables(conn)
+    if not tables:
+        return []
+    ids = [row[0] for row in conn.execute('SELECT rowid FROM expenses_archive_fts WHERE expenses_archive_fts MATCH ? '
+                                          'ORDER BY rowid DESC LIMIT ? OFFSET ?', (match, limit, offset))]
+    if not ids:
+        return []
+    placeholders = ', '.join('?' * len(ids))
+    found = {}
+    for table in tables:
+        for row in conn.execute(f'SELECT id, description, amount_cents / 100.0, date, category, user_id FROM {table} '
+                                f'WHERE id IN ({placeholders})', ids):
+            found[row[0]] = tuple(row)
+    return [found[expense_id] for expense_id in ids if expense_id in found]
+
+
+# {id: (description, amount, date, category)} для архивных расходов пользователя из ids
+def fetch_archived(conn, user_id, ids):
+    ids = list(ids)
+    found = {}
+    for table in archive_tables(conn):
+        placeholders = ', '.join('?' * len(ids))
+        found.update((row[0], tuple(row[1:])) for row in conn.execute(
+            f'SELECT id, description, amount_cents / 100.0, date, category FROM {table} '
+            f'WHERE user_id = ? AND id IN ({placeholders})', [user_id] + ids))
+    return found
+
+
+# Строки в архиве по годам: [(год, archived_before, строк)]
+def archive_status(conn):
+    return [(year, archived_before, conn.execute(f'SELECT COUNT(*) FROM {archive_table(year)}').fetchone()[0])
+            for year, archived_before in archived_years(conn)]
@@ -0,0 +1,240 @@
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('budget.backup')
+
+DEFAULT_STEP_PAGES = 256
+DEFAULT_STEP_SLEEP = 0.005
+# Сколько раз копия может начаться заново из-за записей в источник, прежде чем
+# оставшееся будет скопировано одним шагом (в WAL это одна читающая транзакция,
+# записи она не блокирует — только откладывает checkpoint)
+MAX_RESTARTS = 3
+LOCK_NAME = '.backup.lock'
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def snapshot_pattern(path):
+    return re.compile(rf'^{re.escape(_stem(path))}-\d{{8}}T\d{{6}}Z\.db\.gz$')
+
+
+# Снимки базы path в directory, новые сначала
+def list_snapshots(path, directory):
+    if not os.path.isdir(directory):
+        return []
+    pattern = snapshot_pattern(path)
+    return sorted((name for name in os.listdir(directory) if pattern.match(name)), reverse=True)
+
+
+# Возраст последнего снимка в секундах или None, если снимков нет
+def latest_snapshot_age(path, directory):
+    snapshots = list_snapshots(path, directory)
+    if not snapshots:
+        return None
+    return time.time() - os.path.getmtime(os.path.join(directory, snapshots[0]))
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _Restarted(Exception):
+    pass
+
+
+# Копия живой базы через sqlite3 backup API порциями по step_pages страниц с паузой
+# step_sleep между ними: каждый шаг держит чтение источника недолго, запросы не ждут.
+# Запись в источник из другого соединения начинает копию заново; после MAX_RESTARTS
+# повторов остаток копируется одним шагом. Возвращает (страниц, шагов, повторов).
+def copy_database(path, target, step_pages=DEFAULT_STEP_PAGES, step_sleep=DEFAULT_STEP_SLEEP):
+    source = sqlite3.connect(path, timeout=30)
+    destination = sqlite3.connect(target)
+    state = {'steps': 0, 'restarts': 0, 'remaining': None, 'total': 0}
+
+    def progress(status, remaining, total):
+        state['steps'] += 1
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+        state['remaining'], state['total'] = remaining, total
+        if state['restarts'] >= MAX_RESTARTS:
+            raise _Restarted()
+        if remaining and step_sleep:
+            time.sleep(step_sleep)
+
+    try:
+        try:
+            source.backup(destination, pages=step_pages, progress=progress)
+        except _Restarted:
+            logger.warning('Снимок %s начинался заново %d раз, остаток копируется одним шагом',
+                           path, state['restarts'])
+            source.backup(destination, pages=-1)
+            state['steps'] += 1
+            state['total'] = destination.execute('PRAGMA page_count').fetchone()[0]
+        check = destination.execute('PRAGMA quick_check').fetchone()[0]
+        if check != 'ok':
+            raise sqlite3.DatabaseError(f'Снимок {path} не прошёл quick_check: {check}')
+    finally:
+        destination.close()
+        source.close()
+    return state['total'], state['steps'], state['restarts']
+
+
+# Снимок базы path в directory: budget-20250131T020000Z.db.gz и рядом .sha256 в формате
+# sha256sum (проверка: sha256sum -c). Сжатие и контрольная сумма считаются по временной
+# копии, а не по живой базе. Старые снимки сверх keep удаляются.
+def backup_database(path, directory, keep=7, step_pages=DEFAULT_STEP_PAGES, step_sleep=DEFAULT_STEP_SLEEP,
+                    level=6):
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    name = f'{_stem(path)}-{stamp}.db.gz'
+    snapshot = os.path.join(directory, name)
+    copy = os.path.join(directory, f'.{_stem(path)}-{stamp}.db.tmp')
+    compressed = snapshot + '.tmp'
+    try:
+        pages, steps, restarts = copy_database(path, copy, step_pages, step_sleep)
+        copied = time.perf_counter()
+        with open(copy, 'rb') as f, gzip.open(compressed, 'wb', compresslevel=level) as out:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        size = os.path.getsize(copy)
+        checksum = _sha256_file(compressed)
+        with open(snapshot + '.sha256', 'w', encoding='utf-8') as f:
+            f.write(f'{checksum}  {name}\n')
+        # Снимок появляется под своим именем только целиком
+        os.replace(compressed, snapshot)
+    finally:
+        for leftover in (copy, compressed):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    removed = prune_snapshots(path, directory, keep)
+    finished = time.perf_counter()
+    return {
+        'database': path,
+        'snapshot': snapshot,
+        'sha256': checksum,
+        'pages': pages,
+        'steps': steps,
+        'restarts': restarts,
+        'bytes': size,
+        'compressed_bytes': os.path.getsize(snapshot),
+        'copy_seconds': round(copied - started, 3),
+        'seconds': round(finished - started, 3),
+        'removed': removed,
+    }
+
+
+def prune_snapshots(path, directory, keep):
+    removed = []
+    for name in list_snapshots(path, directory)[max(keep, 1):]:
+        for filename in (name, name + '.sha256'):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+        removed.append(name)
+    return removed
+
+
+# Сверка снимка с его .sha256
+def verify_snapshot(snapshot):
+    with open(snapshot + '.sha256', encoding='utf-8') as f:
+        expected = f.read().split()[0]
+    return _sha256_file(snapshot) == expected
+
+
+# Один снимок за раз на каталог, даже из нескольких процессов: flock на файле блокировки.
+# Возвращает открытый файл блокировки или None, если снимки уже делает кто-то другой.
+def try_lock(directory):
+    os.makedirs(directory, exist_ok=True)
+    lock = open(os.path.join(directory, LOCK_NAME), 'a')
+    if fcntl is None:
+        return lock
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+# Снимки всех баз (каталог и шарды) подряд под общей блокировкой.
+# max_age — пропустить базу, если её последний снимок моложе (для фонового задания).
+def backup_all(paths, directory, keep=7, step_pages=DEFAULT_STEP_PAGES, step_sleep=DEFAULT_STEP_SLEEP,
+               max_age=None):
+    lock = try_lock(directory)
+    if lock is None:
+        return None
+    try:
+        results = []
+        for path in paths:
+            if max_age is not None:
+                age = latest_snapshot_age(path, directory)
+                if age is not None and age < max_age:
+                    continue
+            results.append(backup_database(path, directory, keep, step_pages, step_sleep))
+        return results
+    finally:
+        lock.close()
+
+
+# Фоновые снимки по расписанию. Поток запускается в каждом воркере gunicorn, но снимок
+# делает только один: остальные не получат блокировку или увидят свежий снимок.
+class BackupScheduler:
+    def __init__(self, paths, directory, interval, keep=7, step_pages=DEFAULT_STEP_PAGES,
+                 step_sleep=DEFAULT_STEP_SLEEP):
+        self.paths = list(paths)
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.step_pages = step_pages
+        self.step_sleep = step_sleep
+        self.last_results = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='backup', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Проверяем чаще интервала, чтобы после перезапуска воркеров снимок не откладывался на целый интервал
+        check_every = min(self.interval, 60)
+        while True:
+            try:
+                results = backup_all(self.paths, self.directory, self.keep, self.step_pages, self.step_sleep,
+                                     max_age=self.interval)
+                for result in results or ():
+                    logger.info('Снимок %s: %d страниц за %.3f с (%d шагов, %d повторов), %d -> %d байт',
+                                result['snapshot'], result['pages'], result['seconds'], result['steps'],
+                                result['restarts'], result['bytes'], result['compressed_bytes'])
+                if results:
+                    self.last_results = results
+            except Exception:
+                logger.exception('Не удалось сделать снимок')
+            time.sleep(check_every)
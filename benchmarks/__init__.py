@@ -0,0 +1 @@
+# Бенчмарки запускаются из корня проекта: python -m benchmarks.<имя>
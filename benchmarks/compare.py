@@ -0,0 +1,59 @@
+# Сравнение двух файлов результатов harness: изменение RPS и задержек по сценариям.
+# Пример: python -m benchmarks.compare before.json after.json --threshold 10
+import argparse
+import sys
+
+from benchmarks import results
+
+
+def change(before, after):
+    if not before:
+        return None
+    return (after - before) / before * 100
+
+
+def format_change(value):
+    return '     —' if value is None else f'{value:+6.1f}%'
+
+
+def describe(run):
+    git = run['git']
+    commit = (git['commit'] or 'unknown')[:10] + (' (dirty)' if git['dirty'] else '')
+    dataset = run['dataset']
+    return (f'{commit}, {run["timestamp"]}, {run["config"].get("mode")}, '
+            f'{dataset["users"]} польз. / {dataset["expenses"]} расходов')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение двух прогонов benchmarks.harness')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Код выхода 1, если p95 какого-либо сценария вырос больше чем на столько процентов')
+    args = parser.parse_args()
+
+    before, after = results.load(args.before), results.load(args.after)
+    print(f'было:  {describe(before)}')
+    print(f'стало: {describe(after)}')
+    if before['config'] != after['config'] or before['dataset'] != after['dataset']:
+        print('внимание: конфигурация или набор данных прогонов различаются')
+    print(f'{"сценарий":<20} {"RPS было":>9} {"RPS стало":>9} {"ΔRPS":>7} {"p95 было":>9} {"p95 стало":>9} {"Δp95":>7}')
+    regressions = []
+    for name in sorted(set(before['results']) | set(after['results'])):
+        old, new = before['results'].get(name), after['results'].get(name)
+        if old is None or new is None:
+            print(f'{name:<20} есть только в одном из прогонов')
+            continue
+        rps_change = change(old['throughput_rps'], new['throughput_rps'])
+        p95_change = change(old['latency_ms']['p95'], new['latency_ms']['p95'])
+        print(f'{name:<20} {old["throughput_rps"]:>9.1f} {new["throughput_rps"]:>9.1f} {format_change(rps_change)} '
+              f'{old["latency_ms"]["p95"]:>9.2f} {new["latency_ms"]["p95"]:>9.2f} {format_change(p95_change)}')
+        if args.threshold is not None and p95_change is not None and p95_change > args.threshold:
+            regressions.append(name)
+    if regressions:
+        print(f'Регрессия p95 больше {args.threshold}%: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Цена сжатия ответов: время CPU против сэкономленных байт для gzip, br и zstd на разных уровнях.
+# «Окупается до» — скорость канала, ниже которой сжатие сокращает общее время ответа
+# (сэкономленные байты / время сжатия). Пример: python -m benchmarks.compression --rows 50000
+import argparse
+import json
+
+import compressor
+import serialization
+from benchmarks.serialization import make_connection, measure
+from storage import EXPENSE_COLUMNS, EXPENSE_FIELDS
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 6), 'zstd': (1, 3, 9)}
+STREAM_CHUNK_ROWS = 1000
+
+
+def make_payloads(rows):
+    conn = make_connection(rows)
+    data = conn.execute(f'SELECT {EXPENSE_COLUMNS} FROM expenses WHERE user_id = 1').fetchall()
+    lines = [serialization.dumps(dict(zip(EXPENSE_FIELDS, row))) for row in data]
+    # Выгрузка NDJSON порциями, как в /expenses/export.ndjson
+    chunks = [b'\n'.join(lines[index:index + STREAM_CHUNK_ROWS]) + b'\n'
+              for index in range(0, len(lines), STREAM_CHUNK_ROWS)]
+    return {
+        'expenses 50 (records)': serialization.encode_rows(EXPENSE_FIELDS, data[:50]),
+        'expenses 500 (records)': serialization.encode_rows(EXPENSE_FIELDS, data[:500]),
+        'expenses 500 (columnar)': serialization.encode_rows(EXPENSE_FIELDS, data[:500], 'columnar'),
+        f'export.ndjson {rows}': chunks,
+    }
+
+
+def run(payloads, encodings, repeat):
+    results = []
+    for name, payload in payloads.items():
+        streamed = isinstance(payload, list)
+        size = sum(map(len, payload)) if streamed else len(payload)
+        for encoding in encodings:
+            for level in LEVELS[encoding]:
+                if streamed:
+                    def job():
+                        return b''.join(compressor.compress_stream(iter(payload), None, encoding, level))
+                else:
+                    def job():
+                        return compressor.compress(payload, encoding, level)
+                elapsed, compressed = measure(job, repeat)
+                saved = size - compressed
+                results.append({
+                    'payload': name,
+                    'encoding': encoding,
+                    'level': level,
+                    'bytes': size,
+                    'compressed_bytes': compressed,
+                    'ratio': round(size / compressed, 2),
+                    'cpu_ms': round(elapsed * 1000, 3),
+                    'cpu_ms_per_mb': round(elapsed * 1000 / (size / 1024 / 1024), 2),
+                    'break_even_mbit': round(saved * 8 / elapsed / 1e6, 1) if elapsed else None,
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Стоимость сжатия ответов')
+    parser.add_argument('--rows', type=int, default=50000, help='Строк в выгрузке NDJSON')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    encodings = [encoding for encoding in ('gzip', 'br', 'zstd') if encoding in compressor.available_encodings()]
+    missing = sorted({'gzip', 'br', 'zstd'} - set(encodings))
+    if missing:
+        print(f'Не установлены: {", ".join(missing)}')
+    results = run(make_payloads(args.rows), encodings, args.repeat)
+
+    print(f'{"ответ":<26} {"кодировка":<9} {"байт":>10} {"сжато":>9} {"раз":>6} {"мс CPU":>8} '
+          f'{"мс/МБ":>8} {"окупается до, Мбит/с":>21}')
+    for result in results:
+        print(f'{result["payload"]:<26} {result["encoding"] + ":" + str(result["level"]):<9} '
+              f'{result["bytes"]:>10} {result["compressed_bytes"]:>9} {result["ratio"]:>6} '
+              f'{result["cpu_ms"]:>8} {result["cpu_ms_per_mb"]:>8} {result["break_even_mbit"]:>21}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
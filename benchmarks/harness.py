@@ -0,0 +1,320 @@
+# Нагрузочный прогон маршрутов приложения через Flask test client или живой gunicorn.
+# Результаты пишутся в JSON (см. results.py), их можно сравнивать между коммитами.
+# Примеры:
+#   python -m benchmarks.seed --db /tmp/bench.db --users 50 --expenses 5000
+#   python -m benchmarks.harness --db /tmp/bench.db --mode client --output before.json
+#   python -m benchmarks.harness --db /tmp/bench.db --mode gunicorn --workers 4 --concurrency 16
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from typing import NamedTuple
+
+from benchmarks import results
+from benchmarks.seed import BENCH_PASSWORD
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Тело запроса: dict — форма, Json — JSON, Upload — файл в multipart/form-data
+class Json(NamedTuple):
+    value: object
+
+
+class Upload(NamedTuple):
+    field: str
+    filename: str
+    content: bytes
+
+
+# Сценарий: метод, путь и тело; путь и тело могут быть функциями (rng, state).
+# prepare(session, rng, state) выполняется перед каждым запросом вне замера и кладёт в
+# state то, что запрос изменит (например, id расхода для удаления): записи сценария
+# работают со своими строками, и прогоны повторяются. В state всегда есть credentials.
+# login=False — поток не входит перед замером. Время prepare в задержки не входит,
+# но RPS таких сценариев считается по всему окну и поэтому ниже.
+class Scenario(NamedTuple):
+    method: str
+    path: object
+    body: object = None
+    prepare: object = None
+    login: bool = True
+
+
+def random_date(rng):
+    return f'2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+
+
+def random_expense(rng):
+    return {'description': 'Бенчмарк', 'amount': f'{rng.randint(100, 99999) / 100:.2f}',
+            'date': random_date(rng), 'category': rng.choice(['Еда', 'Транспорт', 'Кафе'])}
+
+
+def random_period(rng):
+    year = rng.randint(2023, 2025)
+    return f'date_from={year}-{rng.randint(1, 12):02d}-01&date_to={year}-12-31'
+
+
+# Создаёт count расходов пакетом и возвращает их id
+def create_expenses(session, rng, count):
+    status, content = session.request('POST', '/api/expenses/batch',
+                                      Json({'create': [random_expense(rng) for _ in range(count)]}))
+    if status != 200:
+        raise RuntimeError(f'Не удалось создать расходы для сценария: HTTP {status}')
+    return json.loads(content)['created']
+
+
+def prepare_delete(session, rng, state):
+    state['ids'] = create_expenses(session, rng, 1)
+
+
+def prepare_batch(session, rng, state):
+    state['ids'] = create_expenses(session, rng, 10)
+
+
+# Журнал изменений: запоминаем последний номер, затем создаём и удаляем пять расходов
+def prepare_changes(session, rng, state):
+    _, content = session.request('GET', '/expenses/changes')
+    state['since'] = json.loads(content)['last_seq']
+    session.request('POST', '/api/expenses/batch', Json({'delete': create_expenses(session, rng, 5)}))
+
+
+def prepare_logout(session, rng, state):
+    session.request('POST', '/login', state['credentials'])
+
+
+def import_file(rng):
+    lines = ['date;amount;description;category']
+    for _ in range(100):
+        expense = random_expense(rng)
+        lines.append(f"{expense['date']};{expense['amount']};{expense['description']};{expense['category']}")
+    return Upload('file', 'bench.csv', ('\n'.join(lines) + '\n').encode())
+
+
+SCENARIOS = {
+    'index': Scenario('GET', '/'),
+    'expenses': Scenario('GET', '/expenses'),
+    'expenses_by_amount': Scenario('GET', '/expenses?sort=-amount&limit=100'),
+    'expenses_month': Scenario('GET', lambda rng, state: f'/expenses?date_from={rng.randint(2023, 2025)}-'
+                                                         f'{rng.randint(1, 12):02d}-01&date_to={rng.randint(2023, 2025)}-12-31'),
+    'summary': Scenario('GET', '/summary'),
+    'search': Scenario('GET', lambda rng, state: '/expenses/search?q=' + urllib.parse.quote(
+        rng.choice(['такси', 'кофе', 'аренда', 'прод']))),
+    'changes': Scenario('GET', lambda rng, state: f'/expenses/changes?since={state["since"]}', prepare=prepare_changes),
+    'export_csv': Scenario('GET', lambda rng, state: '/expenses/export.csv?' + random_period(rng)),
+    'export_ndjson': Scenario('GET', lambda rng, state: '/expenses/export.ndjson?' + random_period(rng)),
+    'forecast': Scenario('GET', lambda rng, state: f'/forecast?years={rng.choice([1, 5, 10])}'
+                                                   f'&resolution={rng.choice(["day", "month"])}'),
+    'balance': Scenario('GET', lambda rng, state: f'/balance?date={random_date(rng)}'),
+    'balance_range': Scenario('GET', lambda rng, state: '/balance/range?' + random_period(rng)),
+    'balance_history': Scenario('GET', lambda rng, state: f'/balance/history?date_to={random_date(rng)}'
+                                                          f'&step={rng.choice(["day", "week"])}'),
+    'add': Scenario('POST', '/add', lambda rng, state: random_expense(rng)),
+    'delete': Scenario('POST', lambda rng, state: f'/delete/{state["ids"][0]}', prepare=prepare_delete),
+    'batch': Scenario('POST', '/api/expenses/batch', lambda rng, state: Json({
+        'create': [random_expense(rng) for _ in range(5)],
+        'update': [{'id': expense_id, 'amount': f'{rng.randint(100, 99999) / 100:.2f}'}
+                   for expense_id in state['ids'][:5]],
+        'delete': state['ids'][5:],
+    }), prepare=prepare_batch),
+    'import': Scenario('POST', '/import', lambda rng, state: import_file(rng)),
+    'login': Scenario('POST', '/login', lambda rng, state: state['credentials'], login=False),
+    'logout': Scenario('GET', '/logout', prepare=prepare_logout, login=False),
+    # Каждый запрос регистрирует нового пользователя: имя уникально и между прогонами
+    'register': Scenario('POST', '/register', lambda rng, state: {
+        'username': f'bench_register_{uuid.uuid4().hex}', 'password': BENCH_PASSWORD}, login=False),
+}
+DEFAULT_SCENARIOS = list(SCENARIOS)
+
+
+# Клиент поверх Flask test client: запросы не проходят через сеть
+class TestClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        if isinstance(body, Json):
+            arguments = {'json': body.value}
+        elif isinstance(body, Upload):
+            arguments = {'data': {body.field: (io.BytesIO(body.content), body.filename)}}
+        else:
+            arguments = {'data': body}
+        response = self.client.open(path, method=method, **arguments)
+        content = response.get_data()
+        response.close()
+        return response.status_code, content
+
+
+# Клиент поверх HTTP с собственными cookie
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect())
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if isinstance(body, Json):
+            data = json.dumps(body.value).encode()
+            headers['Content-Type'] = 'application/json'
+        elif isinstance(body, Upload):
+            boundary = uuid.uuid4().hex
+            data = (f'--{boundary}\r\nContent-Disposition: form-data; name="{body.field}"; '
+                    f'filename="{body.filename}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+            data += body.content + f'\r\n--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        else:
+            data = urllib.parse.urlencode(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def list_bench_users(db_path, limit):
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    users = [row[0] for row in conn.execute(
+        "SELECT username FROM user WHERE username LIKE 'bench_%' ORDER BY id LIMIT ?", (limit,))]
+    conn.close()
+    if not users:
+        raise SystemExit('В базе нет пользователей bench_*: сначала запустите python -m benchmarks.seed')
+    return users
+
+
+def run_scenario(name, make_session, users, concurrency, duration, max_requests):
+    scenario = SCENARIOS[name]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    window = {}
+    # Вход выполняется до старта замера: иначе scrypt съедает окно коротких сценариев
+    barrier = threading.Barrier(concurrency, action=lambda: window.update(
+        started=time.perf_counter(), deadline=time.perf_counter() + duration))
+
+    def worker(index):
+        nonlocal errors
+        rng = random.Random(index)
+        session = make_session()
+        username = users[index % len(users)]
+        state = {'credentials': {'username': username, 'password': BENCH_PASSWORD}}
+        if scenario.login:
+            session.request('POST', '/login', state['credentials'])
+        barrier.wait()
+        local, local_errors = [], 0
+        while time.perf_counter() < window['deadline'] and len(local) < max_requests:
+            if scenario.prepare is not None:
+                scenario.prepare(session, rng, state)
+            target = scenario.path(rng, state) if callable(scenario.path) else scenario.path
+            body = scenario.body(rng, state) if callable(scenario.body) else scenario.body
+            started = time.perf_counter()
+            status, _ = session.request(scenario.method, target, body)
+            local.append(time.perf_counter() - started)
+            if status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.summarize(latencies, errors, time.perf_counter() - window['started'])
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex((host, port)) == 0:
+                return
+        time.sleep(0.2)
+    raise SystemExit(f'gunicorn не запустился на {host}:{port}')
+
+
+def start_gunicorn(port, workers, threads, env=None):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--chdir', ROOT, '--workers', str(workers),
+         '--worker-class', 'gthread', '--threads', str(threads),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        env=dict(os.environ, **(env or {})))
+    wait_for_port('127.0.0.1', port)
+    return server
+
+
+def stop_gunicorn(server):
+    server.terminate()
+    server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон маршрутов приложения')
+    parser.add_argument('--db', required=True, help='База, заполненная benchmarks.seed')
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'url'], default='client')
+    parser.add_argument('--url', help='Адрес уже запущенного сервера для --mode url')
+    parser.add_argument('--scenarios', nargs='+', default=DEFAULT_SCENARIOS, choices=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0, help='Секунд на сценарий')
+    parser.add_argument('--max-requests', type=int, default=100000, help='Предел запросов на поток')
+    parser.add_argument('--workers', type=int, default=2, help='Воркеров gunicorn')
+    parser.add_argument('--threads', type=int, default=8, help='Потоков на воркер gunicorn')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='Файл для результатов в JSON')
+    args = parser.parse_args()
+
+    db_path = os.path.abspath(args.db)
+    os.environ['DATABASE_URL'] = db_path
+    users = list_bench_users(db_path, max(args.concurrency, 1))
+    server = None
+    if args.mode == 'client':
+        sys.path.insert(0, ROOT)
+        from app import app
+        make_session = lambda: TestClientSession(app)
+    else:
+        base_url = args.url
+        if args.mode == 'gunicorn':
+            base_url = f'http://127.0.0.1:{args.port}'
+            server = start_gunicorn(args.port, args.workers, args.threads)
+        if not base_url:
+            raise SystemExit('Для --mode url нужен --url')
+        make_session = lambda: HttpSession(base_url.rstrip('/'))
+
+    config = {key: getattr(args, key) for key in ('mode', 'concurrency', 'duration', 'workers', 'threads')}
+    run = results.new_run(config, db_path)
+    try:
+        print(f'{"сценарий":<20} {"запросов":>9} {"ошибок":>7} {"RPS":>9} {"p50 мс":>8} {"p95 мс":>8} {"p99 мс":>8}')
+        for name in args.scenarios:
+            summary = run_scenario(name, make_session, users, args.concurrency, args.duration, args.max_requests)
+            run['results'][name] = summary
+            latency = summary['latency_ms']
+            print(f'{name:<20} {summary["requests"]:>9} {summary["errors"]:>7} {summary["throughput_rps"]:>9.1f} '
+                  f'{latency["p50"]:>8.2f} {latency["p95"]:>8.2f} {latency["p99"]:>8.2f}')
+    finally:
+        if server is not None:
+            stop_gunicorn(server)
+    if args.output:
+        results.save(run, args.output)
+        print(f'Результаты сохранены в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Сколько хэшей паролей в секунду даёт каждый метод/стоимость.
+# Пример: python -m benchmarks.hashing --methods scrypt:16384:8:1 pbkdf2:sha256:600000 --workers 2
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from hashing import PasswordHasher, normalize_method
+
+
+def measure_inline(method, seconds):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        generate_password_hash('benchmark-password', method)
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def measure_pool(method, seconds, workers):
+    hasher = PasswordHasher(method, workers=workers, queue_size=workers * 2, timeout=60)
+    hasher.hash('warm-up')
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+
+    def loop():
+        nonlocal count
+        while time.perf_counter() < deadline:
+            hasher.hash('benchmark-password')
+            count += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as threads:
+        for _ in range(workers):
+            threads.submit(loop)
+    elapsed = time.perf_counter() - started
+    hasher.shutdown()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Скорость хэширования паролей')
+    parser.add_argument('--methods', nargs='+',
+                        default=['scrypt:16384:8:1', 'scrypt:32768:8:1', 'pbkdf2:sha256:600000'])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    print(f'{"метод":<28} {"в потоке, хэш/с":>16} {"пул x" + str(args.workers) + ", хэш/с":>18}')
+    for method in args.methods:
+        method = normalize_method(method)
+        inline = measure_inline(method, args.seconds)
+        pooled = measure_pool(method, args.seconds, args.workers)
+        print(f'{method:<28} {inline:>16.1f} {pooled:>18.1f}')
+
+
+if __name__ == '__main__':
+    main()
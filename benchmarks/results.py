@@ -0,0 +1,86 @@
+# Формат файла результатов: один прогон harness — один JSON-файл.
+# Версия схемы меняется, если поля удаляются или меняют смысл.
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import time
+
+SCHEMA_VERSION = 1
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def dataset_info(db_path):
+    conn = sqlite3.connect(db_path)
+    users, expenses = conn.execute(
+        'SELECT (SELECT COUNT(*) FROM user), (SELECT COUNT(*) FROM expenses)').fetchone()
+    conn.close()
+    return {'path': db_path, 'users': users, 'expenses': expenses}
+
+
+def new_run(config, db_path):
+    return {
+        'schema_version': SCHEMA_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git': git_revision(),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'config': config,
+        'dataset': dataset_info(db_path),
+        'results': {},
+    }
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# Сводка по одному сценарию; задержки передаются в секундах, в файл пишутся в миллисекундах
+def summarize(latencies, errors, duration):
+    ordered = sorted(latencies)
+    milliseconds = lambda value: round(value * 1000, 3)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'duration_seconds': round(duration, 3),
+        'throughput_rps': round(len(ordered) / duration, 1) if duration > 0 else 0.0,
+        'latency_ms': {
+            'mean': milliseconds(sum(ordered) / len(ordered)) if ordered else 0.0,
+            'p50': milliseconds(percentile(ordered, 0.50)),
+            'p95': milliseconds(percentile(ordered, 0.95)),
+            'p99': milliseconds(percentile(ordered, 0.99)),
+            'max': milliseconds(ordered[-1]) if ordered else 0.0,
+        },
+    }
+
+
+def save(run, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(run, f, ensure_ascii=False, indent=2)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        run = json.load(f)
+    if run.get('schema_version') != SCHEMA_VERSION:
+        raise ValueError(f'{path}: неподдерживаемая версия схемы {run.get("schema_version")}')
+    return run
@@ -0,0 +1,102 @@
+# Генератор синтетических данных: пользователи × расходы с правдоподобным
+# распределением дат, категорий и сумм.
+# Пример: python -m benchmarks.seed --db /tmp/bench.db --users 100 --expenses 10000
+import argparse
+import math
+import os
+import random
+import sqlite3
+import time
+from datetime import date, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import storage
+from hashing import normalize_method
+from migrations import migrate
+
+# Категория: (доля операций, медиана суммы в рублях, разброс, описания)
+CATEGORIES = {
+    'Еда': (0.35, 900, 0.8, ('Продукты', 'Супермаркет', 'Рынок', 'Пекарня')),
+    'Транспорт': (0.2, 350, 0.7, ('Такси', 'Метро', 'Бензин', 'Парковка')),
+    'Кафе': (0.12, 1200, 0.6, ('Кофе', 'Обед', 'Ресторан', 'Доставка еды')),
+    'Развлечения': (0.08, 1500, 0.9, ('Кино', 'Концерт', 'Подписка', 'Игры')),
+    'Здоровье': (0.05, 2000, 1.0, ('Аптека', 'Врач', 'Анализы')),
+    'Одежда': (0.06, 3500, 0.8, ('Одежда', 'Обувь')),
+    'Связь': (0.04, 600, 0.3, ('Мобильная связь', 'Интернет')),
+    'Жильё': (0.04, 35000, 0.2, ('Аренда', 'Коммунальные услуги')),
+    '': (0.06, 500, 1.2, ('Разное', 'Перевод', 'Подарок')),
+}
+BENCH_PASSWORD = 'password'
+
+
+def random_date(rng, start, days):
+    # Выходные чаще будних дней, недавние месяцы чаще старых
+    while True:
+        offset = int(days * (1 - rng.random() ** 1.5))
+        day = start + timedelta(days=min(offset, days - 1))
+        if day.weekday() >= 5 or rng.random() < 0.75:
+            return day
+
+
+def generate_expenses(rng, count, start, days):
+    names = list(CATEGORIES)
+    weights = [CATEGORIES[name][0] for name in names]
+    for category in rng.choices(names, weights, k=count):
+        _, median, sigma, descriptions = CATEGORIES[category]
+        amount_cents = max(100, int(rng.lognormvariate(math.log(median), sigma) * 100))
+        if category == 'Жильё':
+            # Аренда и коммунальные платежи — в начале месяца
+            day = random_date(rng, start, days).replace(day=rng.randint(1, 5))
+        else:
+            day = random_date(rng, start, days)
+        yield rng.choice(descriptions), amount_cents, day.isoformat(), category
+
+
+def seed(path, users, expenses, years=3, seed_value=42, chunk_size=5000):
+    migrate(path)
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    method = normalize_method(os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'))
+    # Хэш одинаковый для всех: пароль один, а считать scrypt тысячи раз незачем
+    password_hash = generate_password_hash(BENCH_PASSWORD, method)
+    start = date.today() - timedelta(days=365 * years)
+    total = 0
+    for number in range(1, users + 1):
+        username = f'bench_{number:05d}'
+        conn.execute('INSERT OR IGNORE INTO user (username, password_hash) VALUES (?, ?)', (username, password_hash))
+        user_id = conn.execute('SELECT id FROM user WHERE username = ?', (username,)).fetchone()[0]
+        # Количество расходов у пользователей разное: немного «тяжёлых», много «лёгких»
+        count = max(1, int(rng.paretovariate(2.0) * expenses / 2))
+        rows = generate_expenses(rng, count, start, 365 * years)
+        while True:
+            chunk = [row for _, row in zip(range(chunk_size), rows)]
+            if not chunk:
+                break
+            storage.insert_expenses(conn, user_id, chunk)
+            conn.commit()
+            total += len(chunk)
+    conn.close()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заполнение базы синтетическими пользователями и расходами')
+    parser.add_argument('--db', required=True, help='Путь к файлу SQLite (будет создан или дополнен)')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--expenses', type=int, default=1000, help='Среднее число расходов на пользователя')
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    total = seed(args.db, args.users, args.expenses, args.years, args.seed)
+    elapsed = time.perf_counter() - started
+    print(f'Создано расходов: {total} для {args.users} пользователей за {elapsed:.1f} с '
+          f'(пароль пользователей bench_NNNNN: {BENCH_PASSWORD})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Сравнение старого пути (sqlite3.Row -> dict -> jsonify) с кортежами + orjson и колоночным форматом.
+# Пример: python -m benchmarks.serialization --rows 50000
+import argparse
+import json
+import sqlite3
+import time
+
+from flask import Flask
+
+import serialization
+from storage import EXPENSE_COLUMNS, EXPENSE_FIELDS
+
+
+def make_connection(rows):
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE expenses (id INTEGER PRIMARY KEY, description TEXT, amount_cents INTEGER,
+                    date TEXT, category TEXT, user_id INTEGER)''')
+    conn.executemany('INSERT INTO expenses VALUES (?, ?, ?, ?, ?, ?)',
+                     [(i, f'Покупка {i}', i * 37 % 100000, f'2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}',
+                       ('Еда', 'Транспорт', 'Жильё')[i % 3], 1) for i in range(1, rows + 1)])
+    return conn
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Скорость сериализации списка расходов')
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    conn = make_connection(args.rows)
+    sql = f'SELECT {EXPENSE_COLUMNS} FROM expenses WHERE user_id = 1'
+    app = Flask(__name__)
+
+    def legacy():
+        # Так работал get_expenses: sqlite3.Row, dict на строку и jsonify
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(sql).fetchall()
+        conn.row_factory = None
+        with app.app_context():
+            return app.json.dumps([dict(row) for row in rows]).encode()
+
+    def tuples_stdlib():
+        rows = conn.execute(sql).fetchall()
+        data = serialization.rows_to_records(EXPENSE_FIELDS, rows)
+        return json.dumps({'expenses': data}, ensure_ascii=False, separators=(',', ':')).encode()
+
+    def tuples_fast():
+        return serialization.encode_rows(EXPENSE_FIELDS, conn.execute(sql).fetchall())
+
+    def columnar_fast():
+        return serialization.encode_rows(EXPENSE_FIELDS, conn.execute(sql).fetchall(), 'columnar')
+
+    encoder = 'orjson' if serialization.orjson is not None else 'json (orjson не установлен)'
+    print(f'{args.rows} строк, кодировщик: {encoder}')
+    print(f'{"вариант":<34} {"мс":>9} {"байт":>12}')
+    for name, func in [('Row + dict + jsonify (как было)', legacy),
+                       ('кортежи + json', tuples_stdlib),
+                       ('кортежи + serialization', tuples_fast),
+                       ('колоночный + serialization', columnar_fast)]:
+        elapsed, size = measure(func, args.repeat)
+        print(f'{name:<34} {elapsed * 1000:>9.1f} {size:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Пропускная способность записи /add под gunicorn: обычные коммиты на каждый запрос
+# против групповой фиксации (GROUP_COMMIT). Каждый режим получает свою копию базы.
+# Пример: python -m benchmarks.writes --db /tmp/bench.db --workers 4 --concurrency 32
+import argparse
+import os
+import shutil
+import tempfile
+
+from benchmarks import results
+from benchmarks.harness import HttpSession, list_bench_users, run_scenario, start_gunicorn, stop_gunicorn
+
+MODES = {
+    'commit-per-request': {'GROUP_COMMIT': 'False'},
+    'group-commit': {'GROUP_COMMIT': 'True'},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Записей в секунду: коммит на запрос против групповой фиксации')
+    parser.add_argument('--db', required=True, help='База, заполненная benchmarks.seed (не изменяется)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-delay-ms', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--output', help='Файл для результатов в JSON')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.db)
+    users = list_bench_users(source, args.concurrency)
+    config = {key: getattr(args, key) for key in ('workers', 'threads', 'concurrency', 'duration',
+                                                   'max_batch', 'max_delay_ms')}
+    run = results.new_run(dict(config, mode='writes'), source)
+    print(f'{"режим":<20} {"записей":>8} {"ошибок":>7} {"записей/с":>10} {"p50 мс":>8} {"p99 мс":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, env in MODES.items():
+            copy = os.path.join(directory, f'{name}.db')
+            shutil.copyfile(source, copy)
+            server = start_gunicorn(args.port, args.workers, args.threads, dict(
+                env, DATABASE_URL=copy, GROUP_COMMIT_MAX_BATCH=str(args.max_batch),
+                GROUP_COMMIT_MAX_DELAY_MS=str(args.max_delay_ms), METRICS_ENABLED='False'))
+            try:
+                summary = run_scenario('add', lambda: HttpSession(f'http://127.0.0.1:{args.port}'), users,
+                                       args.concurrency, args.duration, 10 ** 9)
+            finally:
+                stop_gunicorn(server)
+            run['results'][name] = summary
+            latency = summary['latency_ms']
+            print(f'{name:<20} {summary["requests"]:>8} {summary["errors"]:>7} {summary["throughput_rps"]:>10.1f} '
+                  f'{latency["p50"]:>8.2f} {latency["p99"]:>8.2f}')
+    if args.output:
+        results.save(run, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import zlib
+
+# brotli и zstandard необязательны: без них остаётся gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Уровни по умолчанию — быстрые: сжатие идёт в воркере на каждый ответ
+DEFAULT_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+# Сжимаемые типы. text/event-stream не сжимаем: события короткие, а каждое пришлось бы
+# сбрасывать отдельно — экономии нет, зато лишняя работа на каждый keepalive.
+COMPRESSIBLE_TYPES = frozenset({
+    'application/json', 'application/x-ndjson', 'text/html', 'text/csv', 'text/plain',
+    'text/css', 'application/javascript', 'text/javascript',
+})
+
+
+def available_encodings():
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+# Кодировка с наибольшим q из Accept-Encoding; при равных q — по порядку preferred
+def choose_encoding(accept_encodings, preferred):
+    best, best_quality = None, 0
+    for name in preferred:
+        quality = accept_encodings.quality(name)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+# Потоковый компрессор с одинаковым интерфейсом для всех кодировок:
+# compress(chunk) — очередная порция, flush() — всё накопленное (граница блока), finish() — конец потока
+class StreamCompressor:
+    def __init__(self, encoding, level=None):
+        level = DEFAULT_LEVELS[encoding] if level is None else level
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        elif encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f'Неизвестная кодировка: {encoding}')
+
+    def compress(self, chunk):
+        if self.encoding == 'br':
+            return self._compressor.process(chunk)
+        return self._compressor.compress(chunk)
+
+    def flush(self):
+        if self.encoding == 'gzip':
+            return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'br':
+            return self._compressor.flush()
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(body, encoding, level=None):
+    compressor = StreamCompressor(encoding, level)
+    return compressor.compress(body) + compressor.finish()
+
+
+# Сжатие потокового тела: каждая порция генератора уходит клиенту сразу (со сбросом блока),
+# поэтому выгрузка остаётся потоковой. Исходный итератор закрывается вместе с этим.
+def compress_stream(chunks, body, encoding, level=None):
+    compressor = StreamCompressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if chunk:
+                data = compressor.compress(chunk) + compressor.flush()
+                if data:
+                    yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
@@ -0,0 +1,104 @@
+import os
+import queue
+import sqlite3
+import threading
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Пул соединений с SQLite. Живёт внутри одного процесса (воркера gunicorn),
+# соединения переиспользуются между запросами, поэтому PRAGMA и кэш
+# подготовленных выражений настраиваются только один раз на соединение.
+class ConnectionPool:
+    def __init__(self, path, size=8, timeout=10.0, cached_statements=256, pragmas=(), factory=sqlite3.Connection):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.pragmas = tuple(pragmas)
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=self.size)
+        self._created = 0
+
+    # Соединение с настройками пула, но вне его: не занимает место из size.
+    # Для владельцев, которые держат соединение всё время работы (поток групповой фиксации)
+    def connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=self.factory,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            # После fork() (gunicorn --preload) соединения родителя не используем
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f'Нет свободных соединений с {self.path}')
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            # Незавершённая транзакция не должна попасть в следующий запрос
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def default_pragmas(mmap_size, cache_size_kb, busy_timeout_ms):
+    return (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', int(mmap_size)),
+        # Отрицательное значение cache_size задаётся в килобайтах
+        ('cache_size', -int(cache_size_kb)),
+        ('busy_timeout', int(busy_timeout_ms)),
+        ('temp_store', 'MEMORY'),
+    )
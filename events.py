@@ -0,0 +1,133 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+from collections import defaultdict
+
+MAX_CHANGES_PER_EVENT = 100
+
+
+# Раздача уведомлений об изменениях открытым дашбордам (Server-Sent Events).
+# Общий канал между воркерами gunicorn — сам файл SQLite: фоновый поток каждого
+# воркера проверяет PRAGMA data_version и дочитывает новые записи expense_changes,
+# а затем раскладывает их по очередям подписчиков этого воркера.
+# paths — один файл или список шардов: на каждый свой поток, подписчики общие,
+# номера seq в событиях относятся к шарду пользователя.
+class ChangeHub:
+    def __init__(self, paths, poll_interval=1.0, queue_size=100, max_clients=64):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._wakeups = [threading.Event() for _ in self.paths]
+        self._threads = []
+        self._pid = None
+
+    def _ensure_thread(self):
+        if self._threads and all(thread.is_alive() for thread in self._threads) and self._pid == os.getpid():
+            return
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._subscribers = defaultdict(set)
+            self._threads = []
+        for index, path in enumerate(self.paths):
+            if index < len(self._threads) and self._threads[index].is_alive():
+                continue
+            thread = threading.Thread(target=self._run, args=(path, self._wakeups[index]),
+                                      name=f'change-hub-{index}', daemon=True)
+            thread.start()
+            if index < len(self._threads):
+                self._threads[index] = thread
+            else:
+                self._threads.append(thread)
+
+    def subscribe(self, user_id):
+        with self._lock:
+            self._ensure_thread()
+            if sum(len(queues) for queues in self._subscribers.values()) >= self.max_clients:
+                return None
+            subscription = queue.Queue(maxsize=self.queue_size)
+            self._subscribers[user_id].add(subscription)
+            return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(subscription)
+                if not queues:
+                    del self._subscribers[user_id]
+
+    def client_count(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+    # Изменение сделано в этом воркере — проверить журнал сразу, не дожидаясь интервала
+    def wake(self):
+        if self._threads:
+            for wakeup in self._wakeups:
+                wakeup.set()
+
+    def _run(self, path, wakeup):
+        conn = sqlite3.connect(path, timeout=5)
+        last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM expense_changes').fetchone()[0]
+        data_version = None
+        while True:
+            wakeup.wait(self.poll_interval)
+            wakeup.clear()
+            try:
+                current = conn.execute('PRAGMA data_version').fetchone()[0]
+                if current == data_version:
+                    continue
+                data_version = current
+                last_seq = self._dispatch(conn, last_seq)
+            except sqlite3.Error:
+                # База временно занята — попробуем на следующем круге
+                data_version = None
+
+    def _dispatch(self, conn, last_seq):
+        while True:
+            rows = conn.execute('SELECT seq, user_id, expense_id, op FROM expense_changes WHERE seq > ? '
+                                'ORDER BY seq LIMIT 1000', (last_seq,)).fetchall()
+            if not rows:
+                return last_seq
+            last_seq = rows[-1][0]
+            with self._lock:
+                watched = {user_id for user_id in self._subscribers}
+            changes = defaultdict(list)
+            for seq, user_id, expense_id, op in rows:
+                if user_id in watched:
+                    changes[user_id].append({'id': expense_id, 'op': op})
+            if changes:
+                totals = self._totals(conn, list(changes))
+                for user_id, user_changes in changes.items():
+                    # После массового импорта шлём только начало списка: подробности клиент берёт из журнала
+                    self._publish(user_id, {
+                        'seq': last_seq,
+                        'changes': user_changes[:MAX_CHANGES_PER_EVENT],
+                        'truncated': len(user_changes) > MAX_CHANGES_PER_EVENT,
+                        'total': totals.get(user_id, 0) / 100,
+                    })
+
+    def _totals(self, conn, user_ids):
+        placeholders = ', '.join('?' * len(user_ids))
+        rows = conn.execute(f'SELECT user_id, SUM(total_cents) FROM expense_rollup '
+                            f'WHERE user_id IN ({placeholders}) GROUP BY user_id', user_ids).fetchall()
+        return dict(rows)
+
+    def _publish(self, user_id, message):
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, ()))
+        for subscription in queues:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                # Клиент не успевает читать: он всё равно догонит состояние через /expenses/changes
+                pass
+
+
+def format_event(message, event='change'):
+    return f'id: {message["seq"]}\nevent: {event}\ndata: {json.dumps(message, ensure_ascii=False)}\n\n'
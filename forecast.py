@@ -0,0 +1,183 @@
+import numpy as np
+
+# Прогноз баланса по дням без циклов по дням: все даты — целые номера дней
+# от 1970-01-01 (datetime64[D]), вхождения регулярных операций разворачиваются
+# через np.repeat, а суммы по дням собираются np.bincount.
+
+RESOLUTIONS = ('day', 'week', 'month')
+MAX_DAYS = 366 * 30
+
+_EPOCH_MONTH = np.datetime64('1970-01', 'M')
+
+
+def day_number(value):
+    return np.datetime64(value, 'D').astype(np.int64)
+
+
+def month_number(value):
+    return (np.datetime64(value, 'M') - _EPOCH_MONTH).astype(np.int64)
+
+
+def month_start_days(months):
+    return (_EPOCH_MONTH + months).astype('datetime64[D]').astype(np.int64)
+
+
+# Для каждого правила r — значения first[r], first[r] + step[r], … (count[r] штук) одним массивом
+def _expand(first, step, count):
+    count = np.maximum(count, 0)
+    total = int(count.sum())
+    owner = np.repeat(np.arange(len(count)), count)
+    offsets = np.arange(total) - np.repeat(np.cumsum(count) - count, count)
+    return owner, first[owner] + offsets * step[owner]
+
+
+# Правила с шагом в днях (daily, weekly): номера дней вхождений внутри [lo, hi]
+def _day_step_occurrences(start, step, lo, hi):
+    first = np.where(start >= lo, start, start + -(-(lo - start) // step) * step)
+    count = np.where(hi >= first, (hi - first) // step + 1, 0)
+    return _expand(first, step, count)
+
+
+# Правила с шагом в месяцах (monthly, yearly): день месяца берётся из даты начала
+# и ограничивается длиной месяца (31-е число в феврале — последний день февраля)
+def _month_step_occurrences(start, step, first_day, last_day):
+    anchor_month = (start.astype('datetime64[D]').astype('datetime64[M]') - _EPOCH_MONTH).astype(np.int64)
+    anchor_day = start - month_start_days(anchor_month)
+    lo_month = month_number(np.datetime64(first_day, 'D'))
+    hi_month = month_number(np.datetime64(last_day, 'D'))
+    first_k = np.maximum(0, -(-(lo_month - anchor_month) // step))
+    count = np.where(hi_month >= anchor_month, (hi_month - anchor_month) // step - first_k + 1, 0)
+    owner, months = _expand(anchor_month + first_k * step, step, count)
+    month_length = month_start_days(months + 1) - month_start_days(months)
+    return owner, month_start_days(months) + np.minimum(anchor_day[owner], month_length - 1)
+
+
+# rules: последовательность (kind, amount_cents, frequency, interval, start_date, end_date).
+# Возвращает поток по дням окна [first_day, first_day + days): доходы и расходы в копейках.
+def rule_flows(rules, first_day, days):
+    income = np.zeros(days)
+    expenses = np.zeros(days)
+    if not rules:
+        return income, expenses
+    kind, amount, frequency, interval, start, end = zip(*rules)
+    amount = np.asarray(amount, dtype=np.float64)
+    interval = np.asarray(interval, dtype=np.int64)
+    frequency = np.asarray(frequency)
+    start = np.asarray(start, dtype='datetime64[D]').astype(np.int64)
+    last_day = first_day + days - 1
+    end = np.asarray([last_day if value is None else day_number(value) for value in end], dtype=np.int64)
+    is_income = np.asarray(kind) == 'income'
+    lo = np.maximum(start, first_day)
+    hi = np.minimum(end, last_day)
+
+    active = hi >= lo
+    occurrences = []
+    selected = np.flatnonzero(active & np.isin(frequency, ('daily', 'weekly')))
+    if len(selected):
+        step = interval[selected] * np.where(frequency[selected] == 'weekly', 7, 1)
+        owner, day = _day_step_occurrences(start[selected], step, lo[selected], hi[selected])
+        occurrences.append((selected[owner], day))
+    selected = np.flatnonzero(active & np.isin(frequency, ('monthly', 'yearly')))
+    if len(selected):
+        step = interval[selected] * np.where(frequency[selected] == 'yearly', 12, 1)
+        owner, day = _month_step_occurrences(start[selected], step, first_day, last_day)
+        # Вхождения до начала правила, до окна или после end_date отбрасываем
+        keep = (day >= lo[selected][owner]) & (day <= hi[selected][owner])
+        occurrences.append((selected[owner][keep], day[keep]))
+    for rule, day in occurrences:
+        index = day - first_day
+        income += np.bincount(index, weights=np.where(is_income[rule], amount[rule], 0), minlength=days)
+        expenses += np.bincount(index, weights=np.where(is_income[rule], 0, amount[rule]), minlength=days)
+    return income, expenses
+
+
+# budgets: (category, limit_cents, start_month, end_month). Лимит месяца считается планом
+# переменных трат и равномерно распределяется по дням месяца. В первом месяце окна
+# распределяется только остаток лимита после уже сделанных трат (spent по категории).
+def budget_flows(budgets, first_day, days, spent=None):
+    if not budgets:
+        return np.zeros(days)
+    spent = spent or {}
+    category, limit, start_month, end_month = zip(*budgets)
+    first_month = month_number(np.datetime64(int(first_day), 'D'))
+    last_month = month_number(np.datetime64(int(first_day + days - 1), 'D'))
+    lo = np.maximum(np.asarray([month_number(value) for value in start_month], dtype=np.int64), first_month)
+    hi = np.minimum(np.asarray([last_month if value is None else month_number(value) for value in end_month],
+                               dtype=np.int64), last_month)
+    owner, months = _expand(lo, np.ones(len(lo), dtype=np.int64), hi - lo + 1)
+    if not len(owner):
+        return np.zeros(days)
+    # Если у категории несколько бюджетов, в каждом месяце действует начавшийся последним
+    _, category_code = np.unique(np.asarray(category), return_inverse=True)
+    starts = np.asarray(start_month)[owner]
+    order = np.lexsort((starts, months, category_code[owner]))
+    owner, months = owner[order], months[order]
+    group = category_code[owner] * (last_month + 1) + months
+    latest = np.append(group[1:] != group[:-1], True)
+    owner, months = owner[latest], months[latest]
+    amount = np.asarray(limit, dtype=np.float64)[owner]
+    already = np.asarray([spent.get(value, 0) for value in category], dtype=np.float64)[owner]
+    amount = np.where(months == first_month, np.maximum(amount - already, 0), amount)
+    begin = np.maximum(month_start_days(months) - first_day, 0)
+    month_end = month_start_days(months + 1) - first_day
+    # Остаток лимита делится на оставшиеся дни месяца, даже если окно кончается раньше
+    rate = amount / (month_end - begin)
+    finish = np.minimum(month_end, days)
+    # Разностный массив: +rate с первого дня месяца, −rate после последнего
+    difference = np.zeros(days + 1)
+    np.add.at(difference, begin, rate)
+    np.add.at(difference, finish, -rate)
+    return np.cumsum(difference[:-1])
+
+
+# scheduled: уже внесённые операции с датой внутри окна, (date, income_cents, expense_cents)
+def scheduled_flows(scheduled, first_day, days):
+    income = np.zeros(days)
+    expenses = np.zeros(days)
+    if scheduled:
+        day, income_cents, expense_cents = zip(*scheduled)
+        index = np.asarray(day, dtype='datetime64[D]').astype(np.int64) - first_day
+        income += np.bincount(index, weights=np.asarray(income_cents, dtype=np.float64), minlength=days)
+        expenses += np.bincount(index, weights=np.asarray(expense_cents, dtype=np.float64), minlength=days)
+    return income, expenses
+
+
+def _period_starts(first_day, days, resolution):
+    if resolution == 'day':
+        return np.arange(days)
+    if resolution == 'week':
+        return np.arange(0, days, 7)
+    dates = np.arange(first_day, first_day + days).astype('datetime64[D]')
+    starts = np.flatnonzero(dates.astype('datetime64[M]').astype('datetime64[D]') == dates)
+    return starts if len(starts) and starts[0] == 0 else np.concatenate(([0], starts))
+
+
+# Проекция баланса: inputs — результат planning.fetch_forecast_inputs
+def project(inputs, start, days, resolution='day', use_budgets=True):
+    first_day = int(day_number(start))
+    rule_income, rule_expenses = rule_flows(inputs['rules'], first_day, days)
+    known_income, known_expenses = scheduled_flows(inputs['scheduled'], first_day, days)
+    income = rule_income + known_income
+    expenses = rule_expenses + known_expenses
+    if use_budgets:
+        expenses += budget_flows(inputs['budgets'], first_day, days, inputs['spent'])
+    balance = inputs['opening_cents'] + np.cumsum(income - expenses)
+
+    starts = _period_starts(first_day, days, resolution)
+    ends = np.append(starts[1:], days) - 1
+    lowest = int(np.argmin(balance))
+    negative = np.flatnonzero(balance < 0)
+    dates = np.arange(first_day, first_day + days).astype('datetime64[D]')
+    return {
+        'start': str(dates[0]),
+        'days': days,
+        'resolution': resolution,
+        'opening_balance': round(inputs['opening_cents'] / 100, 2),
+        'periods': np.datetime_as_string(dates[starts]).tolist(),
+        'income': (np.add.reduceat(income, starts) / 100).round(2).tolist(),
+        'expenses': (np.add.reduceat(expenses, starts) / 100).round(2).tolist(),
+        'balance': (balance[ends] / 100).round(2).tolist(),
+        'final_balance': round(float(balance[-1]) / 100, 2),
+        'min_balance': {'date': str(dates[lowest]), 'amount': round(float(balance[lowest]) / 100, 2)},
+        'first_negative': str(dates[negative[0]]) if len(negative) else None,
+    }
@@ -0,0 +1,44 @@
+import threading
+from collections import OrderedDict
+
+
+# LRU-кэш отрисованных фрагментов страниц по пользователю. Фрагмент действителен
+# для одной версии данных пользователя: после любой записи версия растёт,
+# и следующий запрос отрисует фрагмент заново, заменив старую запись.
+class FragmentCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, version):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None and item[0] == version:
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, version, fragment):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[user_id] = (version, fragment)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,137 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class WriterBusy(Exception):
+    pass
+
+
+# Групповая фиксация записей: запросы воркера кладут операцию в очередь, фоновый
+# поток собирает до max_batch операций (или ждёт не дольше max_delay после первой)
+# и выполняет их в одной транзакции BEGIN IMMEDIATE с одним COMMIT. Каждая операция
+# идёт в своей точке сохранения, поэтому ошибка одной не отменяет остальные.
+# submit() возвращает управление только после COMMIT — ответ клиенту уходит,
+# когда запись уже зафиксирована.
+class GroupCommitWriter:
+    def __init__(self, connect, max_batch=64, max_delay=0.005, queue_size=1024, timeout=30.0, on_commit=None):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.on_commit = on_commit
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._conn = None
+        self.batches = 0
+        self.writes = 0
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return self._queue
+            if self._pid != os.getpid():
+                # После fork() поток и соединение родителя в дочернем процессе не используем
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._conn = None
+            # Упавший поток перезапускается на той же очереди: ждущие в ней операции не теряются
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name='group-commit', daemon=True)
+            self._thread.start()
+            return self._queue
+
+    # func(conn, *args) выполняется в потоке записи; commit делать не нужно
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            self._ensure_thread().put_nowait((func, args, future))
+        except queue.Full:
+            raise WriterBusy()
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Ещё не начатую операцию отменяем, иначе она выполнится позже и повтор клиента её задвоит
+            if future.cancel():
+                raise WriterBusy()
+            # Операция уже выполняется: её результат и есть ответ
+            return future.result()
+
+    def _collect(self, pending):
+        batch = [pending.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, pending):
+        # Соединение переживает перезапуск потока, чтобы не открывать новое
+        if self._conn is None:
+            self._conn = self.connect()
+        conn = self._conn
+        if conn.in_transaction:
+            conn.rollback()
+        while True:
+            batch = self._collect(pending)
+            try:
+                self._write(conn, batch)
+            except BaseException as error:
+                # Неожиданная ошибка: операции пачки получают её, поток завершается
+                # и будет запущен заново при следующем submit()
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error if isinstance(error, Exception) else RuntimeError(error))
+                raise
+
+    def _write(self, conn, batch):
+        started = time.perf_counter()
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for func, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute('SAVEPOINT group_write')
+                try:
+                    results.append((future, func(conn, *args), None))
+                    conn.execute('RELEASE group_write')
+                except Exception as error:
+                    conn.execute('ROLLBACK TO group_write')
+                    conn.execute('RELEASE group_write')
+                    results.append((future, None, error))
+            conn.commit()
+        except sqlite3.Error as error:
+            if conn.in_transaction:
+                conn.rollback()
+            # Транзакция не зафиксирована: ошибку получает вся пачка
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        # Сначала ответы: пачка уже зафиксирована, что бы ни случилось дальше
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        self.batches += 1
+        self.writes += len(results)
+        if self.on_commit is not None:
+            self.on_commit(len(results), time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'writes': self.writes,
+            'average_batch': round(self.writes / self.batches, 2) if self.batches else 0,
+            'queued': self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+        }
@@ -0,0 +1,202 @@
+import codecs
+import csv
+import itertools
+import re
+import time
+
+import storage
+
+# Названия колонок CSV (в нижнем регистре), которые понимает импорт
+CSV_COLUMNS = {
+    'description': ('description', 'описание', 'назначение', 'назначение платежа', 'payee', 'memo', 'name'),
+    'amount': ('amount', 'сумма', 'сумма операции', 'sum'),
+    'date': ('date', 'дата', 'дата операции', 'posted'),
+    'category': ('category', 'категория'),
+}
+
+OFX_CHUNK_SIZE = 64 * 1024
+OFX_TRANSACTION = re.compile(r'<STMTTRN>(.*?)</STMTTRN>', re.S | re.I)
+OFX_FIELD = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+
+# line — номер строки, на которой чтение файла остановилось (None, если до данных не дошли)
+class ImportFormatError(ValueError):
+    def __init__(self, message, line=None):
+        super().__init__(message)
+        self.line = line
+
+
+def detect_format(filename):
+    return 'ofx' if filename and filename.lower().endswith(('.ofx', '.qfx')) else 'csv'
+
+
+# Выгрузки российских банков часто в windows-1251: если начало файла
+# не декодируется как UTF-8, основной кодировкой считаем cp1251
+def detect_csv_encoding(stream):
+    if not stream.seekable():
+        return 'utf-8-sig'
+    head = stream.read(OFX_CHUNK_SIZE)
+    stream.seek(0)
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as error:
+        # Обрезанный на границе блока многобайтный символ не считается ошибкой
+        if error.start < len(head) - 3:
+            return 'cp1251'
+    return 'utf-8-sig'
+
+
+# Строки файла по одной. Начало файла говорит только об основной кодировке: каждая строка
+# декодируется ею, а если не получается — второй из UTF-8/cp1251 (cp1251 может начаться
+# дальше первых 64 КБ). Номера строк, которые не декодирует ни одна, попадают в bad.
+def decode_lines(stream, encoding, bad):
+    encodings = ('cp1251', 'utf-8') if encoding == 'cp1251' else ('utf-8', 'cp1251')
+    for line_no, raw in enumerate(stream, start=1):
+        if line_no == 1 and raw.startswith(codecs.BOM_UTF8):
+            raw = raw[len(codecs.BOM_UTF8):]
+        for name in encodings:
+            try:
+                yield raw.decode(name)
+                break
+            except UnicodeDecodeError:
+                pass
+        else:
+            bad.add(line_no)
+            yield raw.decode(encodings[0], errors='replace')
+
+
+# CSV читается построчно из потока; разделитель (, ; или табуляция) определяется по заголовку.
+# Возвращает пары (номер строки, словарь полей); нечитаемая строка приходит с полем error.
+def iter_csv_rows(stream):
+    bad = set()
+    lines = decode_lines(stream, detect_csv_encoding(stream), bad)
+    header_line = next(lines, '')
+    if not header_line.strip():
+        raise ImportFormatError('Пустой файл')
+    delimiter = max(',;\t', key=header_line.count)
+    reader = csv.reader(itertools.chain([header_line], lines), delimiter=delimiter)
+    try:
+        header = [name.strip().lower() for name in next(reader)]
+    except csv.Error as error:
+        raise ImportFormatError(f'Не удалось прочитать заголовок CSV: {error}')
+    positions = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for index, name in enumerate(header):
+            if name in aliases:
+                positions[field] = index
+                break
+    missing = [field for field in ('amount', 'date') if field not in positions]
+    if missing:
+        raise ImportFormatError(f'В заголовке CSV нет колонок: {", ".join(missing)}')
+    while True:
+        line_no = reader.line_num + 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            raise ImportFormatError(f'Строка {line_no}: {error}', line=line_no)
+        # Строки декодируются лениво, поэтому в bad только строки этой записи
+        if bad:
+            bad.clear()
+            yield line_no, {'error': 'Строка не в UTF-8 и не в windows-1251'}
+            continue
+        if not any(cell.strip() for cell in row):
+            continue
+        yield line_no, {field: row[index] if index < len(row) else ''
+                        for field, index in positions.items()}
+
+
+# OFX (SGML 1.x и XML 2.x) читается блоками по 64 КБ, в памяти держится только
+# необработанный хвост. Списания (отрицательный TRNAMT) становятся расходами.
+def iter_ofx_rows(stream):
+    head = stream.read(OFX_CHUNK_SIZE)
+    encoding = 'cp1251' if re.search(rb'CHARSET:\s*1251|encoding="windows-1251"', head, re.I) else 'utf-8'
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    buffer = decoder.decode(head)
+    number = 0
+    while True:
+        position = 0
+        for match in OFX_TRANSACTION.finditer(buffer):
+            number += 1
+            fields = {name.upper(): value.strip() for name, value in OFX_FIELD.findall(match.group(1))}
+            amount = fields.get('TRNAMT', '')
+            record = {
+                'description': fields.get('NAME') or fields.get('MEMO') or '',
+                'amount': amount[1:] if amount.startswith('-') else amount,
+                'date': fields.get('DTPOSTED', '')[:8],
+                'category': '',
+            }
+            if amount and not amount.startswith('-'):
+                record['skip'] = 'поступление, не расход'
+            yield number, record
+            position = match.end()
+        # Держим только начало незавершённой транзакции
+        buffer = buffer[position:]
+        opened = buffer.upper().find('<STMTTRN>')
+        buffer = buffer[opened:] if opened >= 0 else buffer[-16:]
+        chunk = stream.read(OFX_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += decoder.decode(chunk)
+
+
+def parse_record(record):
+    if record.get('error'):
+        raise ValueError(record['error'])
+    if record.get('skip'):
+        return None
+    amount_cents = abs(storage.parse_amount_cents(record['amount']))
+    date = storage.normalize_date(record['date'])
+    description = (record.get('description') or '').strip() or 'Импорт'
+    category = (record.get('category') or '').strip()
+    return description, amount_cents, date, category
+
+
+# Проверяет строки и вставляет их пачками по chunk_size, каждая пачка — отдельная транзакция.
+# Ошибочные строки пропускаются и попадают в отчёт (первые max_errors штук).
+# Если файл перестал читаться, когда часть пачек уже зафиксирована, остальные прочитанные
+# строки тоже фиксируются, а место остановки попадает в report['stopped']: всё до этой строки
+# импортировано. Если до этого ничего не зафиксировано, ImportFormatError пробрасывается.
+def import_expenses(conn, user_id, rows, chunk_size=5000, max_errors=100):
+    report = {'imported': 0, 'skipped': 0, 'failed': 0, 'errors': [], 'stopped': None}
+    started = time.perf_counter()
+    chunk = []
+
+    def flush():
+        storage.insert_expenses(conn, user_id, chunk)
+        conn.commit()
+        report['imported'] += len(chunk)
+        chunk.clear()
+
+    try:
+        for line_no, record in rows:
+            try:
+                parsed = parse_record(record)
+            except ValueError as error:
+                report['failed'] += 1
+                if len(report['errors']) < max_errors:
+                    report['errors'].append({'line': line_no, 'error': str(error)})
+                continue
+            if parsed is None:
+                report['skipped'] += 1
+                continue
+            chunk.append(parsed)
+            if len(chunk) >= chunk_size:
+                flush()
+    except ImportFormatError as error:
+        if not report['imported']:
+            raise
+        report['stopped'] = {'line': error.line, 'error': str(error)}
+    if chunk:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    report['elapsed_seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['imported'] / elapsed) if elapsed > 0 else None
+    return report
+
+
+def import_file(conn, user_id, stream, file_format, chunk_size=5000):
+    rows = iter_ofx_rows(stream) if file_format == 'ofx' else iter_csv_rows(stream)
+    return import_expenses(conn, user_id, rows, chunk_size=chunk_size)
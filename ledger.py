@@ -0,0 +1,283 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import archive
+import storage
+
+# Изменений больше этого проще перечитать целиком, чем накладывать на журнал
+MAX_PATCH_CHANGES = 1000
+LEDGER_COLUMNS = 'id, description, amount_cents, date, category'
+
+
+# Строки (id, description, amount_cents, date, category) в колонки
+def _columns(rows):
+    ids, descriptions, amounts, dates, categories = zip(*rows) if rows else ((), (), (), (), ())
+    days = np.asarray(dates, dtype='datetime64[D]')
+    # Даты не в ISO (старые записи, которые миграция не смогла привести) так не сравнить
+    if len(dates) and not (np.datetime_as_string(days) == np.asarray(dates)).all():
+        raise ValueError('Даты не в формате ISO')
+    encoded = [description.encode() for description in descriptions]
+    return (np.asarray(ids, dtype=np.int64), np.asarray(amounts, dtype=np.int64), days.astype(np.int32),
+            list(categories), np.asarray([len(value) for value in encoded], dtype=np.int64), b''.join(encoded))
+
+
+# Неархивные расходы одного пользователя в колоночном виде: id, суммы в копейках и даты
+# (номер дня от 1970-01-01) — массивы NumPy, категории закодированы словарём, описания
+# лежат одним блоком UTF-8 со смещениями. Фильтры и сортировки считаются по массивам,
+# строки-кортежи собираются только для отдаваемой страницы. seq — номер журнала изменений,
+# до которого журнал актуален, archives — состояние архива на момент загрузки.
+class Ledger:
+    def __init__(self, user_id, version, seq, archives, rows):
+        self.user_id = user_id
+        self.version = version
+        self.seq = seq
+        self.archives = archives
+        ids, amounts, dates, categories, lengths, text = _columns(rows)
+        self.categories = list(dict.fromkeys(categories))
+        self.category_codes = {category: code for code, category in enumerate(self.categories)}
+        self.ids, self.amounts, self.dates, self.text = ids, amounts, dates, text
+        self.codes = np.asarray([self.category_codes[category] for category in categories], dtype=np.int32)
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+        # Порядок строк по (колонка, id) по возрастанию для каждой сортировки
+        self.orders = {'date': np.lexsort((self.ids, self.dates)), 'amount': np.lexsort((self.ids, self.amounts))}
+
+    # Новый журнал с наложенными изменениями: строки с id из removed убираются, rows
+    # (текущее состояние изменённых расходов) дописываются. Старый объект не меняется —
+    # его может читать другой поток. Порядки сортировки не пересчитываются: из них
+    # выбрасываются удалённые строки, новые вставляются бинарным поиском. Описания удалённых
+    # строк остаются в блоке, пока мусора не станет больше половины.
+    def patched(self, version, seq, removed, rows):
+        ids, amounts, dates, categories, lengths, text = _columns(rows)
+        ledger = Ledger.__new__(Ledger)
+        ledger.user_id, ledger.version, ledger.seq, ledger.archives = self.user_id, version, seq, self.archives
+        ledger.categories = list(self.categories)
+        ledger.category_codes = dict(self.category_codes)
+        for category in categories:
+            if category not in ledger.category_codes:
+                ledger.category_codes[category] = len(ledger.categories)
+                ledger.categories.append(category)
+        codes = np.asarray([ledger.category_codes[category] for category in categories], dtype=np.int32)
+        keep = ~np.isin(self.ids, np.fromiter(removed, dtype=np.int64, count=len(removed)))
+        ledger.ids = np.concatenate((self.ids[keep], ids))
+        ledger.amounts = np.concatenate((self.amounts[keep], amounts))
+        ledger.dates = np.concatenate((self.dates[keep], dates))
+        ledger.codes = np.concatenate((self.codes[keep], codes))
+        ends = np.cumsum(lengths) + len(self.text)
+        ledger.starts = np.concatenate((self.starts[keep], ends - lengths))
+        ledger.ends = np.concatenate((self.ends[keep], ends))
+        ledger.text = self.text + text
+        if len(ledger.text) > 2 * int((ledger.ends - ledger.starts).sum()) + 4096:
+            ledger._compact_text()
+        # Номера оставшихся строк сдвигаются: старый индекс -> новый
+        renumber = np.cumsum(keep) - 1
+        added = np.arange(keep.sum(), len(ledger.ids))
+        ledger.orders = {}
+        for column, values in (('date', ledger.dates), ('amount', ledger.amounts)):
+            order = self.orders[column]
+            ledger.orders[column] = _merge_order(renumber[order[keep[order]]], values, ledger.ids, added)
+        return ledger
+
+    def _compact_text(self):
+        lengths = self.ends - self.starts
+        self.text = b''.join(self.text[start:end] for start, end in zip(self.starts.tolist(), self.ends.tolist()))
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+
+    @property
+    def nbytes(self):
+        arrays = (self.ids, self.amounts, self.dates, self.codes, self.starts, self.ends) + tuple(self.orders.values())
+        return (sum(array.nbytes for array in arrays) + len(self.text)
+                + sum(len(category or '') + 50 for category in self.categories))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _mask(self, filters):
+        mask = np.ones(len(self.ids), dtype=bool)
+        if filters['date_from']:
+            mask &= self.dates >= _day(filters['date_from'])
+        if filters['date_to']:
+            mask &= self.dates <= _day(filters['date_to'])
+        if filters['category']:
+            code = self.category_codes.get(filters['category'])
+            if code is None:
+                mask[:] = False
+            else:
+                mask &= self.codes == code
+        return mask
+
+    def rows(self, indexes):
+        ids = self.ids[indexes].tolist()
+        amounts = (self.amounts[indexes] / 100).tolist()
+        dates = np.datetime_as_string(self.dates[indexes].astype('datetime64[D]')).tolist()
+        starts, ends = self.starts[indexes].tolist(), self.ends[indexes].tolist()
+        categories = [self.categories[code] for code in self.codes[indexes].tolist()]
+        return [(expense_id, self.text[start:end].decode(), amount, date, category, self.user_id)
+                for expense_id, start, end, amount, date, category
+                in zip(ids, starts, ends, amounts, dates, categories)]
+
+    # То же, что storage.fetch_expense_page без архивных таблиц: строки в порядке EXPENSE_FIELDS и курсор
+    def page(self, filters):
+        column, direction = storage.SORTS[filters['sort']]
+        column = 'date' if column == 'date' else 'amount'
+        values = self.dates if column == 'date' else self.amounts
+        mask = self._mask(filters)
+        if filters['cursor']:
+            value, expense_id = filters['cursor']
+            value = _day(value) if column == 'date' else value
+            if direction == 'ASC':
+                mask &= (values > value) | ((values == value) & (self.ids > expense_id))
+            else:
+                mask &= (values < value) | ((values == value) & (self.ids < expense_id))
+        order = self.orders[column]
+        if direction == 'DESC':
+            order = order[::-1]
+        selected = order[mask[order]][:filters['limit'] + 1]
+        next_cursor = None
+        if len(selected) > filters['limit']:
+            selected = selected[:filters['limit']]
+            last = selected[-1]
+            value = self.rows(selected[-1:])[0][3] if column == 'date' else int(self.amounts[last])
+            next_cursor = storage.encode_cursor(filters['sort'], value, int(self.ids[last]))
+        return self.rows(selected), next_cursor
+
+
+# Вставка строк added в order — индексы, упорядоченные по (values, ids)
+def _merge_order(order, values, ids, added):
+    if not len(added):
+        return order
+    added = added[np.lexsort((ids[added], values[added]))]
+    sorted_values = values[order]
+    positions = []
+    for index in added.tolist():
+        low = int(np.searchsorted(sorted_values, values[index], 'left'))
+        high = int(np.searchsorted(sorted_values, values[index], 'right'))
+        positions.append(low + int(np.searchsorted(ids[order[low:high]], ids[index])))
+    return np.insert(order, positions, added)
+
+
+def _day(value):
+    return int(np.datetime64(value, 'D').astype(np.int64))
+
+
+# LRU-кэш колоночных журналов пользователей в памяти воркера, ограниченный по байтам.
+# Запись действительна, пока не изменилась версия данных пользователя (user_data_version):
+# её поднимает любая запись из любого воркера, поэтому проверка — один запрос по ключу.
+# PRAGMA data_version не подходит: она меняется при записи любого пользователя файла.
+# Устаревший журнал не перечитывается целиком: изменённые после его seq расходы берутся
+# по журналу изменений (expense_changes). Полная загрузка — при первом обращении, после
+# сжатия журнала, архивации или слишком большого числа изменений.
+class LedgerCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.patches = 0
+        self.evictions = 0
+
+    # Журнал пользователя или None, если его нельзя держать в кэше
+    def get(self, conn, user_id):
+        # Версию читаем до загрузки строк: запись между ними даст лишнюю перезагрузку, но не устаревший кэш
+        version = storage.get_data_version(conn, user_id)
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None and item[0].version == version:
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return item[0]
+            stale = item[0] if item is not None else None
+            self.misses += 1
+        archives = archive.archived_years(conn)
+        ledger = self._patch(conn, stale, version) if stale is not None and stale.archives == archives else None
+        if ledger is None:
+            # Номер журнала читаем до строк: изменения между ними наложатся повторно, это безопасно
+            seq = storage.get_last_change_seq(conn, user_id)
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(f'SELECT {LEDGER_COLUMNS} FROM expenses WHERE user_id = ?', (user_id,)).fetchall()
+            try:
+                ledger = Ledger(user_id, version, seq, archives, rows)
+            except ValueError:
+                ledger = None
+            with self._lock:
+                if stale is not None:
+                    self.invalidations += 1
+            if ledger is None:
+                self.discard(user_id)
+                return None
+        else:
+            with self._lock:
+                self.patches += 1
+        self.put(ledger)
+        return ledger
+
+    # stale с изменениями после stale.seq или None, если журнал изменений для этого не годится
+    def _patch(self, conn, stale, version):
+        floor = conn.execute('SELECT changes_floor FROM user_data_version WHERE user_id = ?',
+                             (stale.user_id,)).fetchone()
+        if floor and floor[0] > stale.seq:
+            return None
+        changes = conn.execute('SELECT seq, expense_id FROM expense_changes WHERE user_id = ? AND seq > ? '
+                               'ORDER BY seq LIMIT ?', (stale.user_id, stale.seq, MAX_PATCH_CHANGES + 1)).fetchall()
+        if len(changes) > MAX_PATCH_CHANGES:
+            return None
+        if not changes:
+            # Версия поднялась без изменений строк: массивы общие со старым журналом
+            ledger = copy.copy(stale)
+            ledger.version = version
+            return ledger
+        ids = list({row[1] for row in changes})
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f'SELECT {LEDGER_COLUMNS} FROM expenses WHERE user_id = ? '
+                              f'AND id IN ({", ".join("?" * len(ids))})', [stale.user_id] + ids).fetchall()
+        try:
+            return stale.patched(version, changes[-1][0], ids, rows)
+        except ValueError:
+            return None
+
+    def put(self, ledger):
+        size = ledger.nbytes
+        with self._lock:
+            if ledger.user_id in self._items:
+                self._discard(ledger.user_id)
+            if size > self.max_bytes:
+                return
+            self._items[ledger.user_id] = (ledger, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                user_id = next(iter(self._items))
+                self._discard(user_id)
+                self.evictions += 1
+
+    def discard(self, user_id):
+        with self._lock:
+            if user_id in self._items:
+                self._discard(user_id)
+
+    def _discard(self, user_id):
+        _, size = self._items.pop(user_id)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'patches': self.patches,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
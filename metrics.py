@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+# Границы корзин гистограмм в секундах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'budget_http_requests_total': ('counter', 'Обработано HTTP-запросов'),
+    'budget_http_request_duration_seconds': ('histogram', 'Время обработки запроса вместе с отправкой тела'),
+    'budget_http_response_bytes_total': ('counter', 'Отправлено байт в телах ответов'),
+    'budget_request_phase_seconds': ('histogram', 'Время этапа внутри одного запроса'),
+    'budget_sql_statement_duration_seconds': ('histogram', 'Время выполнения выражения SQL (execute)'),
+    'budget_sql_fetch_seconds_total': ('counter', 'Время чтения строк результата'),
+    'budget_sql_rows_total': ('counter', 'Прочитано строк результата'),
+    'budget_sql_statements_total': ('counter', 'Выполнено выражений SQL'),
+    'budget_group_commit_batches_total': ('counter', 'Транзакций групповой фиксации'),
+    'budget_group_commit_writes_total': ('counter', 'Операций, записанных групповой фиксацией'),
+    'budget_group_commit_seconds': ('histogram', 'Время транзакции групповой фиксации'),
+}
+
+slow_query_log = logging.getLogger('budget.slow_sql')
+
+_SPACES = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+_local = threading.local()
+
+
+# Метка выражения: пробелы схлопнуты, списки «?, ?, ?» сведены к одному,
+# чтобы IN (...) разной длины не порождал новые временные ряды
+@lru_cache(maxsize=1024)
+def statement_label(sql):
+    return _PLACEHOLDER_LIST.sub('?…', _SPACES.sub(' ', sql).strip())[:160]
+
+
+# Счётчики и гистограммы одного воркера. При заданном directory фоновый поток
+# воркера раз в flush_interval сбрасывает снимок в metrics-<pid>.json, а /metrics
+# суммирует снимки всех воркеров — так же, как multiprocess-режим prometheus_client.
+class Metrics:
+    def __init__(self, directory=None, flush_interval=5.0, buckets=LATENCY_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._pid = os.getpid()
+        self._dirty = False
+        self._thread = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _check_pid(self):
+        # После fork() счётчики родителя уже учтены в его собственном файле
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._counters = {}
+            self._histograms = {}
+            self._thread = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Счётчики по корзинам, затем сумма и количество наблюдений
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            self._dirty = False
+            return {
+                'buckets': list(self.buckets),
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, dict(labels), list(values)] for (name, labels), values in self._histograms.items()],
+            }
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    # Запускает поток сброса в этом процессе; дешёвая проверка, можно звать на каждый запрос
+    def start(self):
+        if not self.directory or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            self._check_pid()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+    def flush(self):
+        if not self.directory:
+            return
+        path = self._path(os.getpid())
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)
+
+    def _worker_snapshots(self):
+        yield self.snapshot()
+        if not self.directory:
+            return
+        own = os.path.basename(self._path(os.getpid()))
+        for name in os.listdir(self.directory):
+            if name == own or not name.startswith('metrics-') or not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if snapshot.get('buckets') == list(self.buckets):
+                yield snapshot
+
+    # Файлы завершившихся воркеров: их счётчики пропадают из суммы,
+    # Prometheus воспринимает это как сброс счётчика
+    def remove_stale_files(self):
+        if not self.directory:
+            return
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r'metrics-(\d+)\.json', name)
+            if match and not _pid_alive(int(match.group(1))):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def aggregate(self):
+        counters, histograms = {}, {}
+        for snapshot in self._worker_snapshots():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                total = histograms.setdefault(key, [0] * len(values))
+                for index, value in enumerate(values):
+                    total[index] += value
+        return counters, histograms
+
+    # Текстовый формат Prometheus 0.0.4
+    def render(self):
+        counters, histograms = self.aggregate()
+        series = {}
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault(name, []).append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for (name, labels), values in sorted(histograms.items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-2] + [values[-1] - sum(values[:-2])]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(values[-2])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {values[-1]}')
+        output = []
+        for name in sorted(series):
+            kind, description = HELP.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(series[name])
+        return '\n'.join(output) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Время этапов текущего запроса (ожидание соединения, SQL, хэширование,
+# сериализация) копится в thread-local и записывается в конце запроса
+def begin_request():
+    _local.phases = {}
+
+
+def end_request():
+    phases = getattr(_local, 'phases', None)
+    _local.phases = None
+    return phases or {}
+
+
+def add_phase(phase, seconds):
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - started)
+
+
+# Курсор, замеряющий execute и чтение строк. Таймер на чтение добавляется
+# к метке того выражения, которое курсор выполнил последним.
+class InstrumentedCursor(sqlite3.Cursor):
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._metrics = connection.metrics
+        self._slow_seconds = connection.slow_query_seconds
+        self._label = None
+        self._elapsed = 0.0
+        self._logged = False
+
+    def _record_execute(self, sql, started):
+        elapsed = time.perf_counter() - started
+        self._label = statement_label(sql)
+        self._elapsed = elapsed
+        self._logged = False
+        self._metrics.observe('budget_sql_statement_duration_seconds', elapsed, statement=self._label)
+        self._metrics.inc('budget_sql_statements_total', statement=self._label)
+        add_phase('sql', elapsed)
+        self._check_slow()
+
+    def _record_fetch(self, rows, started):
+        elapsed = time.perf_counter() - started
+        if self._label is None:
+            return
+        self._elapsed += elapsed
+        self._metrics.inc('budget_sql_fetch_seconds_total', elapsed, statement=self._label)
+        if rows:
+            self._metrics.inc('budget_sql_rows_total', rows, statement=self._label)
+        add_phase('sql', elapsed)
+        self._check_slow()
+
+    def _check_slow(self):
+        if self._slow_seconds and not self._logged and self._elapsed >= self._slow_seconds:
+            self._logged = True
+            slow_query_log.warning('Медленный запрос %.1f мс: %s', self._elapsed * 1000, self._label)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record_execute(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record_execute(sql, started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._record_fetch(0 if row is None else 1, started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record_fetch(len(rows), started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._record_fetch(len(rows), started)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record_fetch(0, started)
+            raise
+        self._record_fetch(1, started)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    metrics = None
+    slow_query_seconds = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# Класс соединения для sqlite3.connect(factory=...), пишущий в заданный реестр
+def connection_factory(metrics, slow_query_ms=0):
+    return type('InstrumentedConnection', (InstrumentedConnection,), {
+        'metrics': metrics,
+        'slow_query_seconds': slow_query_ms / 1000 if slow_query_ms > 0 else None,
+    })
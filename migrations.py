@@ -0,0 +1,320 @@
+import logging
+import sqlite3
+
+from werkzeug.security import generate_password_hash
+
+from archive import archive_tables
+from balance import rebuild_balance_index
+from storage import normalize_date, rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+
+# 1. Исходная схема: пользователи, расходы и тестовый пользователь
+# (в файлах шардов пользователей нет, там seed=False)
+def create_initial_schema(conn, seed=True):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            description TEXT NOT NULL,
+            amount REAL NOT NULL,
+            date TEXT NOT NULL,
+            category TEXT,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    ''')
+    user_count = conn.execute('SELECT COUNT(*) FROM user').fetchone()[0]
+    if seed and user_count == 0:
+        cursor = conn.execute("INSERT INTO user (username, password_hash) VALUES (?, ?)",
+                              ('test_user', generate_password_hash('password')))
+        user_id = cursor.lastrowid
+        conn.execute("INSERT INTO expenses (description, amount, date, category, user_id) VALUES (?, ?, ?, ?, ?)",
+                     ('Покупка продуктов', 5000, '2025-09-10', 'Еда', user_id))
+        conn.execute("INSERT INTO expenses (description, amount, date, category, user_id) VALUES (?, ?, ?, ?, ?)",
+                     ('Такси', 1200, '2025-09-10', 'Транспорт', user_id))
+
+
+def _normalize_date_or_keep(value):
+    try:
+        return normalize_date(value)
+    except ValueError:
+        logger.warning('Не удалось привести дату %r к ISO-формату, оставлена как есть', value)
+        return value
+
+
+# 2. Суммы в копейках, даты в ISO, индексы по (user_id, date) и (user_id, category, date)
+def convert_amounts_to_cents(conn):
+    conn.create_function('normalize_date', 1, _normalize_date_or_keep, deterministic=True)
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'expenses'").fetchone()
+    last_id = row[0] if row else 0
+    conn.execute('''
+        CREATE TABLE expenses_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            description TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            category TEXT,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO expenses_new (id, description, amount_cents, date, category, user_id)
+        SELECT id, description, CAST(ROUND(amount * 100) AS INTEGER), normalize_date(date), category, user_id
+        FROM expenses
+    ''')
+    conn.execute('DROP TABLE expenses')
+    conn.execute('ALTER TABLE expenses_new RENAME TO expenses')
+    # Удалённые id не должны выдаваться повторно
+    updated = conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'expenses'", (last_id,))
+    if updated.rowcount == 0 and last_id:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('expenses', ?)", (last_id,))
+    # Индексы покрывают сумму, чтобы итоги за период считались без обращения к таблице
+    conn.execute('CREATE INDEX idx_expenses_user_date ON expenses (user_id, date, amount_cents)')
+    conn.execute('CREATE INDEX idx_expenses_user_category_date ON expenses (user_id, category, date, amount_cents)')
+
+
+# 3. Индекс для сортировки списка по сумме
+def add_amount_sort_index(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_amount ON expenses (user_id, amount_cents)')
+
+
+# 4. Помесячные итоги по категориям, обновляются вместе с expenses (см. storage.py)
+def create_expense_rollup(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expense_rollup (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            category TEXT NOT NULL DEFAULT '',
+            total_cents INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month, category)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_rollups(conn)
+
+
+# 5. Счётчик версии данных пользователя (для ETag и кэшей)
+def create_user_data_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_data_version (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+
+
+# 6. Журнал изменений расходов для дельта-синхронизации клиентов.
+# changes_floor — номер, до которого журнал уже сжат: более старым клиентам нужна полная загрузка.
+def create_expense_changes(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expense_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            expense_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expense_changes_user_seq ON expense_changes (user_id, seq)')
+    conn.execute('ALTER TABLE user_data_version ADD COLUMN changes_floor INTEGER NOT NULL DEFAULT 0')
+
+
+# 7. Полнотекстовый поиск по описанию и категории (FTS5 с внешним содержимым:
+# текст хранится только в expenses, индекс поддерживается триггерами)
+def create_expenses_fts(conn):
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(
+            description, category, user_id,
+            content='expenses', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS expenses_fts_insert AFTER INSERT ON expenses BEGIN
+            INSERT INTO expenses_fts (rowid, description, category, user_id)
+            VALUES (new.id, new.description, new.category, new.user_id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS expenses_fts_delete AFTER DELETE ON expenses BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, description, category, user_id)
+            VALUES ('delete', old.id, old.description, old.category, old.user_id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS expenses_fts_update AFTER UPDATE OF description, category, user_id ON expenses BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, description, category, user_id)
+            VALUES ('delete', old.id, old.description, old.category, old.user_id);
+            INSERT INTO expenses_fts (rowid, description, category, user_id)
+            VALUES (new.id, new.description, new.category, new.user_id);
+        END
+    ''')
+    # Совпадение в описании важнее совпадения в категории; user_id в ранжировании не участвует
+    conn.execute("INSERT INTO expenses_fts (expenses_fts, rank) VALUES ('rank', 'bm25(1.0, 0.5, 0.0)')")
+    conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+# 8. Доходы, регулярные операции и бюджеты для прогноза баланса.
+# Регулярная операция повторяется каждые interval единиц frequency начиная с start_date;
+# для monthly и yearly день (и месяц) берутся из start_date.
+def create_planning_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS income (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            description TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            category TEXT,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_income_user_date ON income (user_id, date, amount_cents)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS recurring (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('income', 'expense')),
+            description TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            category TEXT,
+            frequency TEXT NOT NULL CHECK (frequency IN ('daily', 'weekly', 'monthly', 'yearly')),
+            interval INTEGER NOT NULL DEFAULT 1 CHECK (interval >= 1),
+            start_date TEXT NOT NULL,
+            end_date TEXT,
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring (user_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS budgets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            limit_cents INTEGER NOT NULL,
+            start_month TEXT NOT NULL,
+            end_month TEXT,
+            UNIQUE (user_id, category, start_month),
+            FOREIGN KEY (user_id) REFERENCES user (id)
+        )
+    ''')
+
+
+# 9. Дерево Фенвика по дням для баланса на дату и сумм за период (см. balance.py)
+def create_balance_fenwick(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_fenwick (
+            user_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            sum_cents INTEGER NOT NULL,
+            PRIMARY KEY (user_id, idx)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_balance_index(conn)
+
+
+# 10. Размещение пользователей по шардам (см. shards.py). Таблица нужна только каталогу;
+# moving = 1, пока данные пользователя переносятся в другой шард
+def create_user_shard(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_shard (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            moving INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_shard_shard ON user_shard (shard)')
+
+
+# 11. Реестр архивных таблиц expenses_archive_<год> (см. archive.py). Сами таблицы
+# создаются при архивации; archived_before — граница, до которой строки года перенесены
+def create_expense_archive(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expense_archive (
+            year INTEGER PRIMARY KEY,
+            archived_before TEXT NOT NULL
+        )
+    ''')
+
+
+# 12. Поиск по архивным расходам: FTS5 без содержимого (текст — в expenses_archive_<год>),
+# та же токенизация, что у expenses_fts. Заполняется уже заархивированными строками.
+def create_expense_archive_fts(conn):
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS expenses_archive_fts USING fts5(
+            description, category, user_id,
+            content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    conn.execute("INSERT INTO expenses_archive_fts (expenses_archive_fts, rank) VALUES ('rank', 'bm25(1.0, 0.5, 0.0)')")
+    for table in archive_tables(conn):
+        conn.execute(f'INSERT INTO expenses_archive_fts (rowid, description, category, user_id) '
+                     f'SELECT id, description, category, user_id FROM {table}')
+
+
+# 13. Массовая вставка индексирует пачку одним INSERT ... SELECT вместо триггера на каждую
+# строку: пока в expenses_fts_deferred есть строка (только внутри транзакции вставки,
+# см. storage.insert_expenses), триггер expenses_fts_insert не срабатывает
+def defer_expenses_fts_insert(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS expenses_fts_deferred (id INTEGER PRIMARY KEY)')
+    conn.execute('DROP TRIGGER IF EXISTS expenses_fts_insert')
+    conn.execute('''
+        CREATE TRIGGER expenses_fts_insert AFTER INSERT ON expenses
+        WHEN NOT EXISTS (SELECT 1 FROM expenses_fts_deferred) BEGIN
+            INSERT INTO expenses_fts (rowid, description, category, user_id)
+            VALUES (new.id, new.description, new.category, new.user_id);
+        END
+    ''')
+
+
+# Порядок важен: номер миграции = её позиция в списке (PRAGMA user_version)
+MIGRATIONS = [
+    create_initial_schema,
+    convert_amounts_to_cents,
+    add_amount_sort_index,
+    create_expense_rollup,
+    create_user_data_version,
+    create_expense_changes,
+    create_expenses_fts,
+    create_planning_tables,
+    create_balance_fenwick,
+    create_user_shard,
+    create_expense_archive,
+    create_expense_archive_fts,
+    defer_expenses_fts_insert,
+]
+
+
+def migrate(path, seed=True):
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        # BEGIN IMMEDIATE: если несколько воркеров gunicorn стартуют одновременно,
+        # миграции выполнит только первый, остальные увидят новую версию
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info('Применяется миграция %d: %s', number, migration.__name__)
+                if migration is create_initial_schema:
+                    migration(conn, seed=seed)
+                else:
+                    migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if version < len(MIGRATIONS):
+            conn.execute('PRAGMA optimize')
+    finally:
+        conn.close()
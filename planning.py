@@ -0,0 +1,216 @@
+import archive
+import balance
+import storage
+
+FREQUENCIES = ('daily', 'weekly', 'monthly', 'yearly')
+KINDS = ('income', 'expense')
+
+INCOME_COLUMNS = 'id, description, amount_cents / 100.0 AS amount, date, category'
+INCOME_FIELDS = ('id', 'description', 'amount', 'date', 'category')
+RECURRING_COLUMNS = ('id, kind, description, amount_cents / 100.0 AS amount, category, frequency, interval, '
+                     'start_date, end_date')
+RECURRING_FIELDS = ('id', 'kind', 'description', 'amount', 'category', 'frequency', 'interval',
+                    'start_date', 'end_date')
+BUDGET_COLUMNS = 'id, category, limit_cents / 100.0 AS amount, start_month, end_month'
+BUDGET_FIELDS = ('id', 'category', 'amount', 'start_month', 'end_month')
+
+
+def _text(item, name, required=True):
+    value = item.get(name)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'Нужно поле {name}')
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f'Поле {name} должно быть строкой')
+    return value.strip()
+
+
+def _positive_amount(item):
+    if item.get('amount') is None or isinstance(item['amount'], bool):
+        raise ValueError('Нужна сумма')
+    amount_cents = storage.parse_amount_cents(item['amount'])
+    if amount_cents <= 0:
+        raise ValueError('Сумма должна быть положительной')
+    return amount_cents
+
+
+def parse_income_fields(item):
+    if not isinstance(item, dict):
+        raise ValueError('Ожидается объект')
+    if item.get('date') is None:
+        raise ValueError('Нужна дата')
+    return {
+        'description': _text(item, 'description'),
+        'amount_cents': _positive_amount(item),
+        'date': storage.normalize_date(item['date']),
+        'category': _text(item, 'category', required=False),
+    }
+
+
+def parse_recurring_fields(item):
+    if not isinstance(item, dict):
+        raise ValueError('Ожидается объект')
+    kind = item.get('kind', 'expense')
+    if kind not in KINDS:
+        raise ValueError(f'kind должен быть одним из: {", ".join(KINDS)}')
+    frequency = item.get('frequency', 'monthly')
+    if frequency not in FREQUENCIES:
+        raise ValueError(f'frequency должен быть одним из: {", ".join(FREQUENCIES)}')
+    interval = item.get('interval', 1)
+    if not isinstance(interval, int) or isinstance(interval, bool) or not 1 <= interval <= 1000:
+        raise ValueError('interval должен быть целым числом от 1 до 1000')
+    if item.get('start_date') is None:
+        raise ValueError('Нужна дата начала start_date')
+    start_date = storage.normalize_date(item['start_date'])
+    end_date = storage.normalize_date(item['end_date']) if item.get('end_date') else None
+    if end_date is not None and end_date < start_date:
+        raise ValueError('end_date раньше start_date')
+    return {
+        'kind': kind,
+        'description': _text(item, 'description'),
+        'amount_cents': _positive_amount(item),
+        'category': _text(item, 'category', required=False),
+        'frequency': frequency,
+        'interval': interval,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+
+
+def parse_budget_fields(item):
+    if not isinstance(item, dict):
+        raise ValueError('Ожидается объект')
+    if not item.get('start_month'):
+        raise ValueError('Нужен месяц начала start_month')
+    start_month = storage.parse_month(str(item['start_month']))
+    end_month = storage.parse_month(str(item['end_month'])) if item.get('end_month') else None
+    if end_month is not None and end_month < start_month:
+        raise ValueError('end_month раньше start_month')
+    return {
+        'category': _text(item, 'category', required=False),
+        'limit_cents': _positive_amount(item),
+        'start_month': start_month,
+        'end_month': end_month,
+    }
+
+
+# Как и у расходов, функции записи не делают commit, но поднимают версию
+# данных пользователя — от неё зависят ETag прогноза и кэши
+def insert_income(conn, user_id, fields):
+    cursor = conn.execute('INSERT INTO income (description, amount_cents, date, category, user_id) '
+                          'VALUES (?, ?, ?, ?, ?)',
+                          (fields['description'], fields['amount_cents'], fields['date'], fields['category'], user_id))
+    balance.apply_balance_deltas(conn, user_id, {fields['date']: fields['amount_cents']})
+    storage.bump_data_version(conn, user_id)
+    return cursor.lastrowid
+
+
+def delete_income(conn, user_id, income_id):
+    row = conn.execute('DELETE FROM income WHERE id = ? AND user_id = ? RETURNING amount_cents, date',
+                       (income_id, user_id)).fetchone()
+    if row is None:
+        return 0
+    balance.apply_balance_deltas(conn, user_id, {row[1]: -row[0]})
+    storage.bump_data_version(conn, user_id)
+    return 1
+
+
+def fetch_income(conn, user_id, date_from=None, date_to=None):
+    clauses, params = ['user_id = ?'], [user_id]
+    if date_from:
+        clauses.append('date >= ?')
+        params.append(date_from)
+    if date_to:
+        clauses.append('date <= ?')
+        params.append(date_to)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(f'SELECT {INCOME_COLUMNS} FROM income WHERE {" AND ".join(clauses)} '
+                          f'ORDER BY date DESC, id DESC', params).fetchall()
+
+
+def insert_recurring(conn, user_id, fields):
+    cursor = conn.execute('''
+        INSERT INTO recurring (user_id, kind, description, amount_cents, category, frequency, interval,
+                               start_date, end_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, fields['kind'], fields['description'], fields['amount_cents'], fields['category'],
+          fields['frequency'], fields['interval'], fields['start_date'], fields['end_date']))
+    storage.bump_data_version(conn, user_id)
+    return cursor.lastrowid
+
+
+def delete_recurring(conn, user_id, rule_id):
+    deleted = conn.execute('DELETE FROM recurring WHERE id = ? AND user_id = ?', (rule_id, user_id)).rowcount
+    if deleted:
+        storage.bump_data_version(conn, user_id)
+    return deleted
+
+
+def fetch_recurring(conn, user_id):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(f'SELECT {RECURRING_COLUMNS} FROM recurring WHERE user_id = ? ORDER BY id',
+                          (user_id,)).fetchall()
+
+
+# Бюджет категории с данного месяца; повторная запись того же месяца заменяет лимит
+def upsert_budget(conn, user_id, fields):
+    row = conn.execute('''
+        INSERT INTO budgets (user_id, category, limit_cents, start_month, end_month) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, category, start_month) DO UPDATE SET
+            limit_cents = excluded.limit_cents,
+            end_month = excluded.end_month
+        RETURNING id
+    ''', (user_id, fields['category'], fields['limit_cents'], fields['start_month'], fields['end_month'])).fetchone()
+    storage.bump_data_version(conn, user_id)
+    return row[0]
+
+
+def delete_budget(conn, user_id, budget_id):
+    deleted = conn.execute('DELETE FROM budgets WHERE id = ? AND user_id = ?', (budget_id, user_id)).rowcount
+    if deleted:
+        storage.bump_data_version(conn, user_id)
+    return deleted
+
+
+def fetch_budgets(conn, user_id):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(f'SELECT {BUDGET_COLUMNS} FROM budgets WHERE user_id = ? ORDER BY category, start_month',
+                          (user_id,)).fetchall()
+
+
+# Всё, что нужно forecast.project для окна [start, end]: баланс на начало окна,
+# регулярные операции, бюджеты, траты месяца начала по категориям и уже внесённые
+# операции с датами внутри окна
+def fetch_forecast_inputs(conn, user_id, start, end):
+    rules = conn.execute('SELECT kind, amount_cents, frequency, interval, start_date, end_date FROM recurring '
+                         'WHERE user_id = ? AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)',
+                         (user_id, end, start)).fetchall()
+    budgets = conn.execute('SELECT category, limit_cents, start_month, end_month FROM budgets '
+                           'WHERE user_id = ? AND start_month <= ? AND (end_month IS NULL OR end_month >= ?)',
+                           (user_id, end[:7], start[:7])).fetchall()
+    month_start = start[:7] + '-01'
+    # Архив подключается, только если окно заходит за его границу
+    source = archive.expense_source(conn, month_start, start)
+    spent = conn.execute(f'SELECT category, SUM(amount_cents) FROM {source} '
+                         'WHERE user_id = ? AND date >= ? AND date < ? GROUP BY category',
+                         (user_id, month_start, start)).fetchall()
+    scheduled = conn.execute(f'''
+        SELECT date, SUM(income_cents), SUM(expense_cents) FROM (
+            SELECT date, amount_cents AS income_cents, 0 AS expense_cents FROM income
+            WHERE user_id = ? AND date >= ? AND date <= ?
+            UNION ALL
+            SELECT date, 0, amount_cents FROM {archive.expense_source(conn, start, end)}
+            WHERE user_id = ? AND date >= ? AND date <= ?
+        ) GROUP BY date
+    ''', (user_id, start, end, user_id, start, end)).fetchall()
+    return {
+        'opening_cents': balance.balance_before(conn, user_id, start),
+        'rules': [tuple(row) for row in rules],
+        'budgets': [tuple(row) for row in budgets],
+        'spent': {category or '': cents for category, cents in spent},
+        'scheduled': [tuple(row) for row in scheduled],
+    }
@@ -0,0 +1,36 @@
+import json
+
+# orjson заметно быстрее стандартного json; если он не установлен, работаем без него
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RESPONSE_FORMATS = ('records', 'columnar')
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# Строки из SQLite приходят кортежами; словари собираются прямо из них,
+# без промежуточных sqlite3.Row
+def rows_to_records(columns, rows):
+    return [dict(zip(columns, row)) for row in rows]
+
+
+# Колоночный вид: {"id": [...], "amount": [...], ...} — имена полей не повторяются в каждой строке
+def rows_to_columns(columns, rows):
+    if not rows:
+        return {column: [] for column in columns}
+    return {column: list(values) for column, values in zip(columns, zip(*rows))}
+
+
+def encode_rows(columns, rows, response_format='records', key='expenses', **extra):
+    if response_format == 'columnar':
+        data = rows_to_columns(columns, rows)
+    else:
+        data = rows_to_records(columns, rows)
+    return dumps(dict(extra, **{key: data}))
@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import time
+
+import archive
+from migrations import migrate
+from storage import get_data_version
+
+# Таблицы с записями пользователя, у которых свой AUTOINCREMENT id
+ID_TABLES = ('expenses', 'income', 'recurring', 'budgets')
+# Производные таблицы с ключом user_id: переносятся как есть
+DERIVED_TABLES = ('expense_rollup', 'balance_fenwick')
+USER_TABLES = ID_TABLES + DERIVED_TABLES + ('user_data_version', 'expense_changes')
+# У каждого шарда свой диапазон id: шард k выдаёт id начиная с (k + 1) * ID_SPACE.
+# Старые id из общей базы меньше ID_SPACE, поэтому id, известные клиенту до переноса,
+# в новом шарде никогда не совпадут с чужой записью того же пользователя.
+ID_SPACE = 1 << 40
+
+
+class ShardMoving(Exception):
+    pass
+
+
+# Пути файлов шардов: budget.db -> budget-shard0.db, budget-shard1.db, …
+# или по шаблону вида /data/shard{}.db
+def shard_paths(database, count, template=None):
+    if not template:
+        base, extension = os.path.splitext(database)
+        template = f'{base}-shard{{}}{extension or ".db"}'
+    return [template.format(index) for index in range(count)]
+
+
+def _set_sequence(conn, table, value):
+    updated = conn.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (value, table))
+    if updated.rowcount == 0:
+        conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, value))
+
+
+def _sequence(conn, table):
+    row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    return row[0] if row else 0
+
+
+# Схема шарда — те же миграции, но без тестового пользователя: пользователи живут в каталоге
+def init_shard(path, index):
+    migrate(path, seed=False)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        for table in ID_TABLES:
+            _set_sequence(conn, table, (index + 1) * ID_SPACE)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+# Копирует данные пользователя из source в target (commit не делает). Записи получают
+# новые id из диапазона target, FTS заполняется триггерами. Журнал изменений не переносится:
+# changes_floor выше любого номера источника, поэтому клиенты получат reset и перезагрузятся.
+# Архивные расходы попадают в expenses шарда и уйдут в архив при следующей архивации.
+def copy_user_data(source, target, user_id):
+    read = source.cursor()
+    read.row_factory = None
+    copied = {}
+    for table in ID_TABLES + DERIVED_TABLES:
+        columns = [name for name in _columns(source, table) if name != 'id']
+        order = 'ORDER BY id' if table in ID_TABLES else ''
+        origin = archive.expense_source(source) if table == 'expenses' else table
+        rows = read.execute(f'SELECT {", ".join(columns)} FROM {origin} WHERE user_id = ? {order}',
+                            (user_id,)).fetchall()
+        target.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                           rows)
+        copied[table] = len(rows)
+    floor = max(_sequence(source, 'expense_changes'), _sequence(target, 'expense_changes')) + 1
+    _set_sequence(target, 'expense_changes', floor)
+    # Новая версия данных меняет все ETag пользователя
+    target.execute('INSERT INTO user_data_version (user_id, version, changes_floor) VALUES (?, ?, ?)',
+                   (user_id, get_data_version(source, user_id) + 1, floor))
+    return copied
+
+
+def delete_user_data(conn, user_id):
+    archive.delete_user_archive(conn, user_id)
+    for table in USER_TABLES:
+        conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+
+
+# Маршрутизация пользователей по файлам SQLite. Каталог (основная база) хранит таблицу user
+# и user_shard(user_id, shard, moving); расходы, доходы, итоги, индекс баланса и журнал
+# изменений пользователя целиком лежат в одном шарде. Без шардов всё остаётся в каталоге.
+class ShardRouter:
+    def __init__(self, directory_pool, shard_pools=()):
+        self.directory_pool = directory_pool
+        self.shard_pools = list(shard_pools)
+
+    @property
+    def sharded(self):
+        return bool(self.shard_pools)
+
+    # Пулы файлов с данными пользователей: шарды или сам каталог
+    @property
+    def data_pools(self):
+        return self.shard_pools or [self.directory_pool]
+
+    def locate(self, directory, user_id):
+        if not self.shard_pools:
+            return 0
+        row = directory.execute('SELECT shard, moving FROM user_shard WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return self.place(directory, user_id)
+        if row[1]:
+            raise ShardMoving(user_id)
+        if row[0] >= len(self.shard_pools):
+            raise LookupError(f'Пользователь {user_id} размещён в шарде {row[0]}, а настроено {len(self.shard_pools)}')
+        return row[0]
+
+    def least_loaded(self, directory):
+        users = dict(directory.execute('SELECT shard, COUNT(*) FROM user_shard GROUP BY shard').fetchall())
+        return min(range(len(self.shard_pools)), key=lambda index: (users.get(index, 0), index))
+
+    # Новый пользователь: только запись в каталоге, commit делает вызывающий код
+    def assign(self, directory, user_id):
+        shard = self.least_loaded(directory)
+        directory.execute('INSERT INTO user_shard (user_id, shard) VALUES (?, ?)', (user_id, shard))
+        return shard
+
+    # Пользователь без шарда (создан до включения шардов): его данные переезжают
+    # из таблиц каталога. BEGIN IMMEDIATE не даёт двум воркерам переносить одного пользователя.
+    def place(self, directory, user_id):
+        directory.execute('BEGIN IMMEDIATE')
+        try:
+            row = directory.execute('SELECT shard, moving FROM user_shard WHERE user_id = ?', (user_id,)).fetchone()
+            if row is not None:
+                directory.commit()
+                if row[1]:
+                    raise ShardMoving(user_id)
+                return row[0]
+            shard = self.assign(directory, user_id)
+            self._transfer(directory, shard, user_id)
+            delete_user_data(directory, user_id)
+            directory.commit()
+        except BaseException:
+            if directory.in_transaction:
+                directory.rollback()
+            raise
+        return shard
+
+    def _transfer(self, source, shard, user_id):
+        pool = self.shard_pools[shard]
+        target = pool.acquire()
+        try:
+            # Остатки прерванного переноса
+            delete_user_data(target, user_id)
+            copied = copy_user_data(source, target, user_id)
+            target.commit()
+            return copied
+        finally:
+            pool.release(target)
+
+    # Перенос пользователя в другой шард. Пока стоит флаг moving, его запросы получают 503;
+    # grace — время, за которое успеют завершиться запросы, уже узнавшие старый шард.
+    def move(self, user_id, target, grace=0.0):
+        directory = self.directory_pool.acquire()
+        try:
+            source = self.locate(directory, user_id)
+            if source == target:
+                return None
+            directory.execute('UPDATE user_shard SET moving = 1 WHERE user_id = ?', (user_id,))
+            directory.commit()
+            try:
+                time.sleep(grace)
+                source_pool = self.shard_pools[source]
+                source_conn = source_pool.acquire()
+                try:
+                    # Блокировка записи источника держится до удаления перенесённых строк
+                    source_conn.execute('BEGIN IMMEDIATE')
+                    copied = self._transfer(source_conn, target, user_id)
+                    directory.execute('UPDATE user_shard SET shard = ?, moving = 0 WHERE user_id = ?',
+                                      (target, user_id))
+                    directory.commit()
+                    delete_user_data(source_conn, user_id)
+                    source_conn.commit()
+                finally:
+                    source_pool.release(source_conn)
+            except BaseException:
+                if directory.in_transaction:
+                    directory.rollback()
+                directory.execute('UPDATE user_shard SET moving = 0 WHERE user_id = ? AND shard = ?',
+                                  (user_id, source))
+                directory.commit()
+                raise
+            return copied
+        finally:
+            self.directory_pool.release(directory)
+
+    # Пользователи каталога, ещё не размещённые в шардах
+    def split(self, directory):
+        placed = {}
+        unplaced = [row[0] for row in directory.execute(
+            'SELECT id FROM user WHERE id NOT IN (SELECT user_id FROM user_shard) ORDER BY id').fetchall()]
+        for user_id in unplaced:
+            placed[user_id] = self.place(directory, user_id)
+        return placed
+
+    # Число расходов каждого пользователя по шардам: [{user_id: строк}, …]
+    def loads(self, directory):
+        owners = {}
+        for user_id, shard in directory.execute('SELECT user_id, shard FROM user_shard').fetchall():
+            owners.setdefault(shard, set()).add(user_id)
+        loads = []
+        for index, pool in enumerate(self.shard_pools):
+            conn = pool.acquire()
+            try:
+                rows = conn.execute('SELECT user_id, SUM(count) FROM expense_rollup GROUP BY user_id').fetchall()
+            finally:
+                pool.release(conn)
+            members = owners.get(index, set())
+            shard_load = dict.fromkeys(members, 0)
+            shard_load.update((user_id, count) for user_id, count in rows if user_id in members)
+            loads.append(shard_load)
+        return loads
+
+    # Жадный план: переносим с самого нагруженного шарда на самый свободный самого
+    # крупного пользователя, перенос которого уменьшает разрыв, пока разрыв больше
+    # tolerance от средней нагрузки. Возвращает [(user_id, откуда, куда, строк)].
+    def plan_rebalance(self, loads, tolerance=0.1, max_moves=1000):
+        loads = [dict(shard_load) for shard_load in loads]
+        totals = [sum(shard_load.values()) for shard_load in loads]
+        average = sum(totals) / len(totals) if totals else 0
+        moves = []
+        while len(moves) < max_moves:
+            heavy = max(range(len(totals)), key=totals.__getitem__)
+            light = min(range(len(totals)), key=totals.__getitem__)
+            gap = totals[heavy] - totals[light]
+            if gap == 0 or gap <= tolerance * average:
+                break
+            candidates = [(rows, user_id) for user_id, rows in loads[heavy].items() if 0 < rows <= gap / 2]
+            if not candidates:
+                break
+            rows, user_id = max(candidates)
+            del loads[heavy][user_id]
+            loads[light][user_id] = rows
+            totals[heavy] -= rows
+            totals[light] += rows
+            moves.append((user_id, heavy, light, rows))
+        return moves
@@ -1,42 +1,140 @@
 // Убрал users, currentUser, expenses (локальный массив), login, addExpense и т.д. — теперь данные из Flask.
 
-// Функция для загрузки расходов из Flask
-async function loadExpenses() {
+// Текущие параметры списка: фильтрация, сортировка и постраничный вывод делаются на сервере
+let currentQuery = { sort: '-date' };
+let nextCursor = null;
+// Номер последнего известного изменения в журнале (для дельта-синхронизации)
+let lastSeq = null;
+
+// Функция для загрузки расходов из Flask (append = true — дописать следующую страницу)
+async function loadExpenses(append = false) {
     try {
-        const response = await fetch('/expenses');
-        const expenses = await response.json();
-        displayExpenses(expenses);
-        updateTotal(expenses);
+        const params = new URLSearchParams(currentQuery);
+        if (append && nextCursor) {
+            params.set('cursor', nextCursor);
+        } else {
+            // Номер журнала берём до загрузки списка, чтобы не пропустить изменения между запросами
+            const changes = await (await fetch('/expenses/changes')).json();
+            lastSeq = changes.last_seq;
+        }
+        const response = await fetch('/expenses?' + params.toString());
+        const data = await response.json();
+        if (!response.ok) {
+            alert(data.error || 'Ошибка загрузки расходов');
+            return;
+        }
+        nextCursor = data.next_cursor;
+        displayExpenses(data.expenses, append);
+        if (!append) {
+            updateTotal();
+        }
+        document.getElementById('loadMore').style.display = nextCursor ? '' : 'none';
     } catch (error) {
         console.error('Ошибка загрузки расходов:', error);
     }
 }
 
 // Функция для отображения расходов в таблице
-function displayExpenses(expenses) {
+function displayExpenses(expenses, append = false) {
     const tableBody = document.getElementById('expensesBody');
-    tableBody.innerHTML = ''; // Очистить таблицу
+    if (!append) {
+        tableBody.innerHTML = ''; // Очистить таблицу
+    }
     expenses.forEach((exp) => {
         const row = document.createElement('tr');
-        row.innerHTML = `
-            <td>${exp.description}</td>
-            <td>${exp.amount}</td>
-            <td>${exp.date}</td>
-            <td>${exp.category || ''}</td>
-            <td>
-                <form method="POST" action="/delete/${exp.id}" style="display:inline;">
-                    <button type="submit" onclick="return confirm('Удалить?')">Удалить</button>
-                </form>
-            </td>
-        `;
+        renderRow(row, exp);
         tableBody.appendChild(row);
     });
 }
 
-// Функция для обновления итоговой суммы
-function updateTotal(expenses) {
-    const total = expenses.reduce((sum, exp) => sum + exp.amount, 0);
-    document.getElementById('totalAmount').textContent = total.toFixed(2);
+// Заполнить строку таблицы данными расхода
+function renderRow(row, exp) {
+    row.dataset.id = exp.id;
+    // Разметка совпадает с templates/expense_rows.html. Текст пользователя попадает
+    // в ячейки через textContent, поэтому HTML в описании и категории не исполняется.
+    const cells = [
+        exp.description,
+        exp.amount.toFixed(2) + ' руб.',
+        exp.date,
+        exp.category || 'Без категории',
+    ].map(text => {
+        const cell = document.createElement('td');
+        cell.textContent = text;
+        return cell;
+    });
+
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = '/delete/' + encodeURIComponent(exp.id);
+    form.style.display = 'inline';
+    const button = document.createElement('button');
+    button.type = 'submit';
+    button.className = 'delete-btn';
+    button.textContent = 'Удалить';
+    button.addEventListener('click', event => {
+        if (!confirm('Удалить?')) {
+            event.preventDefault();
+        }
+    });
+    form.appendChild(button);
+    const actions = document.createElement('td');
+    actions.appendChild(form);
+
+    row.replaceChildren(...cells, actions);
+}
+
+// Применить изменения из журнала к показанным строкам. Новые расходы могут попасть
+// в любое место текущей сортировки, поэтому для них перезагружаем страницу.
+async function syncChanges() {
+    if (lastSeq === null) {
+        return;
+    }
+    try {
+        let needsReload = false;
+        let changed = false;
+        let hasMore = true;
+        while (hasMore) {
+            const response = await fetch('/expenses/changes?since=' + lastSeq);
+            const data = await response.json();
+            if (data.reset) {
+                loadExpenses();
+                return;
+            }
+            data.changes.forEach((change) => {
+                const row = document.querySelector(`#expensesBody tr[data-id="${change.id}"]`);
+                if (change.op === 'delete') {
+                    if (row) {
+                        row.remove();
+                    }
+                } else if (row) {
+                    renderRow(row, change.expense);
+                } else {
+                    needsReload = true;
+                }
+                changed = true;
+            });
+            lastSeq = data.last_seq;
+            hasMore = data.has_more;
+        }
+        if (needsReload) {
+            loadExpenses();
+        } else if (changed) {
+            updateTotal();
+        }
+    } catch (error) {
+        console.error('Ошибка синхронизации:', error);
+    }
+}
+
+// Функция для обновления итоговой суммы (считается на сервере по помесячным итогам)
+async function updateTotal() {
+    try {
+        const response = await fetch('/summary');
+        const summary = await response.json();
+        document.getElementById('totalAmount').textContent = summary.total.toFixed(2);
+    } catch (error) {
+        console.error('Ошибка загрузки итогов:', error);
+    }
 }
 
 // Фильтрация по дате
@@ -46,39 +144,60 @@ function filterByDate() {
         alert('Введите дату для фильтрации');
         return;
     }
-    loadExpenses().then(() => {
-        const rows = Array.from(document.querySelectorAll('#expensesBody tr'));
-        rows.forEach(row => {
-            const dateCell = row.cells[2].textContent;
-            row.style.display = dateCell === dateInput ? '' : 'none';
-        });
-    });
+    currentQuery = { ...currentQuery, date_from: dateInput, date_to: dateInput };
+    loadExpenses();
 }
 
 // Сортировка по сумме (убывающая)
 function sortBySum() {
-    loadExpenses().then(() => {
-        const rows = Array.from(document.querySelectorAll('#expensesBody tr'));
-        rows.sort((a, b) => parseFloat(b.cells[1].textContent) - parseFloat(a.cells[1].textContent));
-        const tableBody = document.getElementById('expensesBody');
-        tableBody.innerHTML = '';
-        rows.forEach(row => tableBody.appendChild(row));
-    });
+    currentQuery = { ...currentQuery, sort: '-amount' };
+    loadExpenses();
 }
 
 // Сортировка по дате (возрастающая)
 function sortByDate() {
-    loadExpenses().then(() => {
-        const rows = Array.from(document.querySelectorAll('#expensesBody tr'));
-        rows.sort((a, b) => new Date(a.cells[2].textContent) - new Date(b.cells[2].textContent));
-        const tableBody = document.getElementById('expensesBody');
-        tableBody.innerHTML = '';
-        rows.forEach(row => tableBody.appendChild(row));
+    currentQuery = { ...currentQuery, sort: 'date' };
+    loadExpenses();
+}
+
+// Следующая страница
+function loadMore() {
+    loadExpenses(true);
+}
+
+// Первая страница и сумма уже в разметке: достаточно взять курсор и номер журнала.
+// Без них (пользователь не вошёл) загружаем список как раньше.
+function hydrate() {
+    const initial = document.getElementById('initialState');
+    if (!initial) {
+        loadExpenses();
+        return;
+    }
+    const state = JSON.parse(initial.textContent);
+    nextCursor = state.next_cursor;
+    lastSeq = state.last_seq;
+    subscribeToChanges();
+}
+
+// Подтягивать изменения из других вкладок и устройств: сервер присылает уведомление
+// с новой общей суммой, а сами изменения забираем через журнал. Подписываемся только
+// после входа (есть initialState): без него /events отвечает переадресацией на вход,
+// и браузер переподключался бы к ней бесконечно.
+function subscribeToChanges() {
+    if (!window.EventSource) {
+        return;
+    }
+    const events = new EventSource('/events');
+    events.addEventListener('change', (event) => {
+        const message = JSON.parse(event.data);
+        document.getElementById('totalAmount').textContent = message.total.toFixed(2);
+        syncChanges();
     });
 }
 
-// Загрузить расходы при загрузке страницы
-document.addEventListener('DOMContentLoaded', loadExpenses);
+document.addEventListener('DOMContentLoaded', hydrate);
+window.addEventListener('focus', syncChanges);
+setInterval(syncChanges, 30000);
 
 
 
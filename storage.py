@@ -0,0 +1,612 @@
+import base64
+import json
+import re
+from datetime import date as date_type, datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+import archive
+from balance import MAX_DAY, apply_balance_deltas
+
+# Даты храним в ISO-формате (YYYY-MM-DD): такие строки сортируются как даты
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%Y/%m/%d', '%d/%m/%Y')
+
+# Суммы хранятся в копейках, наружу отдаём рубли. Предел суммы одной записи намного меньше
+# 64-битного INTEGER SQLite, чтобы итоги (expense_rollup, balance_fenwick) не переполнялись
+MAX_AMOUNT_CENTS = 10 ** 15
+EXPENSE_COLUMNS = 'id, description, amount_cents / 100.0 AS amount, date, category, user_id'
+EXPENSE_FIELDS = ('id', 'description', 'amount', 'date', 'category', 'user_id')
+
+# Допустимые сортировки списка: параметр sort -> (колонка, направление)
+SORTS = {
+    'date': ('date', 'ASC'),
+    '-date': ('date', 'DESC'),
+    'amount': ('amount_cents', 'ASC'),
+    '-amount': ('amount_cents', 'DESC'),
+}
+DEFAULT_SORT = '-date'
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+# Поиск ранжирует только столько самых новых совпадений (см. search_expenses)
+SEARCH_RANK_CANDIDATES = 200
+# Последнее слово короче ищется целиком: префикс из одной буквы совпадает почти со всем
+SEARCH_MIN_PREFIX = 2
+
+
+# Даты позже MAX_DAY не помещаются в индекс баланса (balance.py) и отклоняются
+def normalize_date(value):
+    day = _parse_date(value)
+    if day > MAX_DAY:
+        raise ValueError(f'Дата вне поддерживаемого диапазона (не позже {MAX_DAY}): {value}')
+    return day
+
+
+def _parse_date(value):
+    value = str(value).strip()
+    # Быстрый путь для уже правильного формата (важно для массового импорта)
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        try:
+            return date_type.fromisoformat(value).isoformat()
+        except ValueError:
+            pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(value).date().isoformat()
+    except ValueError:
+        raise ValueError(f'Неверная дата: {value}')
+
+
+def parse_amount_cents(value):
+    text = str(value).strip().replace(' ', '').replace(',', '.')
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f'Неверная сумма: {value}')
+    if not amount.is_finite():
+        raise ValueError(f'Неверная сумма: {value}')
+    if abs(amount) * 100 > MAX_AMOUNT_CENTS:
+        raise ValueError(f'Слишком большая сумма: {value}')
+    try:
+        return int((amount * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f'Неверная сумма: {value}')
+
+
+# Изменения расходов, помесячных итогов и индекса баланса выполняются в одной транзакции:
+# функции не делают commit, это остаётся за вызывающим кодом.
+def _insert_row(conn, user_id, description, amount_cents, date, category):
+    cursor = conn.execute(
+        'INSERT INTO expenses (description, amount_cents, date, category, user_id) VALUES (?, ?, ?, ?, ?)',
+        (description, amount_cents, date, category, user_id))
+    apply_rollup_deltas(conn, [(user_id, date[:7], category or '', amount_cents, 1)])
+    apply_balance_deltas(conn, user_id, {date: -amount_cents})
+    log_change(conn, user_id, cursor.lastrowid, 'upsert')
+    return cursor.lastrowid
+
+
+def _delete_row(conn, user_id, expense_id):
+    sql = 'DELETE FROM expenses WHERE id = ? AND user_id = ? RETURNING amount_cents, date, category'
+    row = conn.execute(sql, (expense_id, user_id)).fetchone()
+    # Архивный расход сначала возвращается в expenses, дальше — как обычно
+    if row is None and archive.restore_expense(conn, user_id, expense_id):
+        row = conn.execute(sql, (expense_id, user_id)).fetchone()
+    if row is None:
+        return False
+    apply_rollup_deltas(conn, [(user_id, row[1][:7], row[2] or '', -row[0], -1)])
+    apply_balance_deltas(conn, user_id, {row[1]: row[0]})
+    log_change(conn, user_id, expense_id, 'delete')
+    return True
+
+
+# changes — словарь с любыми из полей description, amount_cents, date, category
+def _update_row(conn, user_id, expense_id, changes):
+    sql = 'SELECT description, amount_cents, date, category FROM expenses WHERE id = ? AND user_id = ?'
+    old = conn.execute(sql, (expense_id, user_id)).fetchone()
+    if old is None and archive.restore_expense(conn, user_id, expense_id):
+        old = conn.execute(sql, (expense_id, user_id)).fetchone()
+    if old is None:
+        return False
+    new = dict(zip(('description', 'amount_cents', 'date', 'category'), old))
+    new.update(changes)
+    conn.execute('UPDATE expenses SET description = ?, amount_cents = ?, date = ?, category = ? WHERE id = ?',
+                 (new['description'], new['amount_cents'], new['date'], new['category'], expense_id))
+    apply_rollup_deltas(conn, [
+        (user_id, old[2][:7], old[3] or '', -old[1], -1),
+        (user_id, new['date'][:7], new['category'] or '', new['amount_cents'], 1),
+    ])
+    # Перенос расхода на другую дату (в том числе задним числом) — два изменения в дереве
+    day_deltas = {old[2]: old[1]}
+    day_deltas[new['date']] = day_deltas.get(new['date'], 0) - new['amount_cents']
+    apply_balance_deltas(conn, user_id, day_deltas)
+    log_change(conn, user_id, expense_id, 'upsert')
+    return True
+
+
+def insert_expense(conn, user_id, description, amount_cents, date, category):
+    expense_id = _insert_row(conn, user_id, description, amount_cents, date, category)
+    bump_data_version(conn, user_id)
+    return expense_id
+
+
+def delete_expense(conn, user_id, expense_id):
+    if not _delete_row(conn, user_id, expense_id):
+        return 0
+    bump_data_version(conn, user_id)
+    return 1
+
+
+# Проверяет поля расхода из JSON; partial=True — для обновления, когда поля необязательны
+def parse_expense_fields(item, partial=False):
+    if not isinstance(item, dict):
+        raise ValueError('Ожидается объект')
+    fields = {}
+    if 'description' in item or not partial:
+        description = item.get('description')
+        if not isinstance(description, str) or not description.strip():
+            raise ValueError('Нужно непустое описание')
+        fields['description'] = description.strip()
+    if 'amount' in item or not partial:
+        if item.get('amount') is None or isinstance(item['amount'], bool):
+            raise ValueError('Нужна сумма')
+        fields['amount_cents'] = parse_amount_cents(item['amount'])
+    if 'date' in item or not partial:
+        if item.get('date') is None:
+            raise ValueError('Нужна дата')
+        fields['date'] = normalize_date(item['date'])
+    if 'category' in item or not partial:
+        category = item.get('category') or ''
+        if not isinstance(category, str):
+            raise ValueError('Категория должна быть строкой')
+        fields['category'] = category.strip()
+    return fields
+
+
+# Пакет изменений одного пользователя в одной транзакции: creates — поля новых
+# расходов, updates — (id, поля), deletes — id. Версия данных растёт один раз.
+def apply_batch(conn, user_id, creates, updates, deletes):
+    result = {'created': [], 'updated': [], 'deleted': [], 'not_found': []}
+    for fields in creates:
+        result['created'].append(_insert_row(conn, user_id, fields['description'], fields['amount_cents'],
+                                             fields['date'], fields['category']))
+    for expense_id, fields in updates:
+        if _update_row(conn, user_id, expense_id, fields):
+            result['updated'].append(expense_id)
+        else:
+            result['not_found'].append(expense_id)
+    for expense_id in deletes:
+        if _delete_row(conn, user_id, expense_id):
+            result['deleted'].append(expense_id)
+        else:
+            result['not_found'].append(expense_id)
+    if result['created'] or result['updated'] or result['deleted']:
+        result['version'] = bump_data_version(conn, user_id)
+    else:
+        result['version'] = get_data_version(conn, user_id)
+    return result
+
+
+# Массовая вставка: rows — список (description, amount_cents, date, category)
+def insert_expenses(conn, user_id, rows):
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'expenses'").fetchone()
+    last_id = sequence[0] if sequence else 0
+    # Поисковый индекс пачки строится одним запросом после вставки: так в два с лишним раза быстрее,
+    # чем триггером на каждую строку (миграция defer_expenses_fts_insert)
+    conn.execute('INSERT OR IGNORE INTO expenses_fts_deferred (id) VALUES (1)')
+    try:
+        conn.executemany(
+            'INSERT INTO expenses (description, amount_cents, date, category, user_id) VALUES (?, ?, ?, ?, ?)',
+            [(description, amount_cents, date, category, user_id)
+             for description, amount_cents, date, category in rows])
+    finally:
+        conn.execute('DELETE FROM expenses_fts_deferred')
+    conn.execute('''
+        INSERT INTO expenses_fts (rowid, description, category, user_id)
+        SELECT id, description, category, user_id FROM expenses WHERE id > ?
+    ''', (last_id,))
+    deltas = {}
+    day_deltas = {}
+    for _, amount_cents, date, category in rows:
+        key = (date[:7], category or '')
+        total = deltas.setdefault(key, [0, 0])
+        total[0] += amount_cents
+        total[1] += 1
+        day_deltas[date] = day_deltas.get(date, 0) - amount_cents
+    apply_rollup_deltas(conn, [(user_id, month, category, cents, count)
+                               for (month, category), (cents, count) in deltas.items()])
+    apply_balance_deltas(conn, user_id, day_deltas)
+    # Журнал для всей пачки пишется одним запросом
+    conn.execute('''
+        INSERT INTO expense_changes (user_id, expense_id, op)
+        SELECT user_id, id, 'upsert' FROM expenses WHERE user_id = ? AND id > ?
+    ''', (user_id, last_id))
+    bump_data_version(conn, user_id)
+    return len(rows)
+
+
+# Журнал изменений: op = 'upsert' (создан или изменён) или 'delete' (надгробие)
+def log_change(conn, user_id, expense_id, op):
+    conn.execute('INSERT INTO expense_changes (user_id, expense_id, op) VALUES (?, ?, ?)',
+                 (user_id, expense_id, op))
+
+
+# Не меньше changes_floor: иначе клиент, начавший с пустого журнала, получал бы reset без конца
+def get_last_change_seq(conn, user_id):
+    row = conn.execute('''
+        SELECT MAX(COALESCE((SELECT MAX(seq) FROM expense_changes WHERE user_id = ?1), 0),
+                   COALESCE((SELECT changes_floor FROM user_data_version WHERE user_id = ?1), 0))
+    ''', (user_id,)).fetchone()
+    return row[0]
+
+
+# Изменения после since. Для upsert отдаём текущее состояние расхода; если клиент
+# отстал дальше сжатой части журнала, возвращаем reset — нужна полная перезагрузка.
+def fetch_changes(conn, user_id, since, limit):
+    floor = conn.execute('SELECT changes_floor FROM user_data_version WHERE user_id = ?', (user_id,)).fetchone()
+    if floor and since < floor[0]:
+        return {'reset': True, 'changes': [], 'last_seq': get_last_change_seq(conn, user_id), 'has_more': False}
+    rows = conn.execute(f'''
+        SELECT c.seq, c.op, c.expense_id, e.description, e.amount_cents / 100.0, e.date, e.category
+        FROM expense_changes c
+        LEFT JOIN expenses e ON e.id = c.expense_id AND e.user_id = c.user_id
+        WHERE c.user_id = ? AND c.seq > ?
+        ORDER BY c.seq
+        LIMIT ?
+    ''', (user_id, since, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    # Изменённый, а затем перенесённый в архив расход ищем в архивных таблицах
+    missing = {row[2] for row in rows if row[1] == 'upsert' and row[3] is None}
+    if missing:
+        archived = archive.fetch_archived(conn, user_id, missing)
+        rows = [(seq, op, expense_id) + archived[expense_id] if op == 'upsert' and expense_id in archived
+                else (seq, op, expense_id, description, amount, date, category)
+                for seq, op, expense_id, description, amount, date, category in rows]
+    # По каждому расходу достаточно последней записи
+    latest = {}
+    for seq, op, expense_id, description, amount, date, category in rows:
+        if op == 'upsert' and description is None:
+            # Расход уже удалён, надгробие будет дальше в журнале
+            continue
+        change = {'seq': seq, 'op': op, 'id': expense_id}
+        if op == 'upsert':
+            change['expense'] = {'id': expense_id, 'description': description, 'amount': amount,
+                                 'date': date, 'category': category, 'user_id': user_id}
+        latest.pop(expense_id, None)
+        latest[expense_id] = change
+    return {
+        'reset': False,
+        'changes': list(latest.values()),
+        'last_seq': rows[-1][0] if rows else since,
+        'has_more': has_more,
+    }
+
+
+# Сжатие журнала: по каждому расходу остаётся только последняя запись, а записи
+# старше keep_days удаляются вместе с поднятием changes_floor пользователя
+def compact_changes(conn, keep_days):
+    deduplicated = conn.execute('''
+        DELETE FROM expense_changes WHERE seq NOT IN (
+            SELECT MAX(seq) FROM expense_changes GROUP BY user_id, expense_id
+        )
+    ''').rowcount
+    horizon = f'-{int(keep_days)} days'
+    conn.execute('''
+        INSERT INTO user_data_version (user_id, version, changes_floor)
+        SELECT user_id, 0, MAX(seq) FROM expense_changes
+        WHERE changed_at < datetime('now', ?)
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET changes_floor = MAX(changes_floor, excluded.changes_floor)
+    ''', (horizon,))
+    expired = conn.execute("DELETE FROM expense_changes WHERE changed_at < datetime('now', ?)",
+                           (horizon,)).rowcount
+    return deduplicated, expired
+
+
+# Версия данных пользователя растёт при каждом изменении его расходов
+def bump_data_version(conn, user_id):
+    row = conn.execute('''
+        INSERT INTO user_data_version (user_id, version) VALUES (?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+        RETURNING version
+    ''', (user_id,)).fetchone()
+    return row[0]
+
+
+def get_data_version(conn, user_id):
+    row = conn.execute('SELECT version FROM user_data_version WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+# deltas: (user_id, месяц YYYY-MM, категория, изменение суммы в копейках, изменение количества)
+def apply_rollup_deltas(conn, deltas):
+    deltas = list(deltas)
+    conn.executemany('''
+        INSERT INTO expense_rollup (user_id, month, category, total_cents, count) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, month, category) DO UPDATE SET
+            total_cents = total_cents + excluded.total_cents,
+            count = count + excluded.count
+    ''', deltas)
+    conn.executemany('DELETE FROM expense_rollup WHERE user_id = ? AND month = ? AND category = ? AND count <= 0',
+                     [delta[:3] for delta in deltas if delta[4] < 0])
+
+
+# Полный пересчёт итогов по expenses вместе с архивом (для заполнения и проверки)
+def rebuild_rollups(conn, user_id=None):
+    where, params = ('WHERE user_id = ?', (user_id,)) if user_id is not None else ('', ())
+    conn.execute(f'DELETE FROM expense_rollup {where}', params)
+    conn.execute(f'''
+        INSERT INTO expense_rollup (user_id, month, category, total_cents, count)
+        SELECT user_id, substr(date, 1, 7), COALESCE(category, ''), SUM(amount_cents), COUNT(*)
+        FROM {archive.expense_source(conn)} {where}
+        GROUP BY user_id, substr(date, 1, 7), COALESCE(category, '')
+    ''', params)
+
+
+# Архивация расходов года старше before (см. archive.py). Версии данных затронутых
+# пользователей растут, чтобы кэши журналов и страниц перечитали расходы.
+def archive_expenses_year(conn, year, before):
+    moved, users = archive.archive_year(conn, year, before)
+    for user_id in users:
+        bump_data_version(conn, user_id)
+    return moved, len(users)
+
+
+# Общая сумма расходов пользователя в копейках
+def fetch_total_cents(conn, user_id):
+    row = conn.execute('SELECT SUM(total_cents) FROM expense_rollup WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] or 0
+
+
+# Итоги по месяцам, категориям и месяц×категория; читаются только из expense_rollup
+def fetch_summary(conn, user_id, month_from=None, month_to=None):
+    clauses, params = ['user_id = ?'], [user_id]
+    if month_from:
+        clauses.append('month >= ?')
+        params.append(month_from)
+    if month_to:
+        clauses.append('month <= ?')
+        params.append(month_to)
+    rows = conn.execute(f'''
+        SELECT month, category, total_cents, count FROM expense_rollup
+        WHERE {" AND ".join(clauses)} ORDER BY month, category
+    ''', params).fetchall()
+    by_month, by_category = {}, {}
+    total_cents = total_count = 0
+    by_month_category = []
+    for month, category, cents, count in rows:
+        by_month.setdefault(month, [0, 0])
+        by_month[month][0] += cents
+        by_month[month][1] += count
+        by_category.setdefault(category, [0, 0])
+        by_category[category][0] += cents
+        by_category[category][1] += count
+        total_cents += cents
+        total_count += count
+        by_month_category.append({'month': month, 'category': category, 'total': cents / 100, 'count': count})
+    return {
+        'total': total_cents / 100,
+        'count': total_count,
+        'by_month': [{'month': month, 'total': cents / 100, 'count': count}
+                     for month, (cents, count) in by_month.items()],
+        'by_category': [{'category': category, 'total': cents / 100, 'count': count}
+                        for category, (cents, count) in sorted(by_category.items())],
+        'by_month_category': by_month_category,
+    }
+
+
+def encode_cursor(sort, value, expense_id):
+    raw = json.dumps([sort, value, expense_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, expense_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Неверный курсор')
+    expected_type = str if SORTS[sort][0] == 'date' else int
+    if cursor_sort != sort or not isinstance(value, expected_type) or not isinstance(expense_id, int):
+        raise ValueError('Курсор не соответствует сортировке')
+    return value, expense_id
+
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m').strftime('%Y-%m')
+    except ValueError:
+        raise ValueError(f'Неверный месяц: {value}')
+
+
+# Разбирает параметры запроса списка расходов; при ошибке бросает ValueError
+def parse_expense_filters(args):
+    filters = {
+        'date_from': None,
+        'date_to': None,
+        'category': args.get('category') or None,
+        'sort': args.get('sort') or DEFAULT_SORT,
+        'limit': DEFAULT_LIMIT,
+        'cursor': None,
+        'format': args.get('format') or 'records',
+    }
+    if args.get('date_from'):
+        filters['date_from'] = normalize_date(args['date_from'])
+    if args.get('date_to'):
+        filters['date_to'] = normalize_date(args['date_to'])
+    if filters['format'] not in ('records', 'columnar'):
+        raise ValueError(f'Неизвестный формат ответа: {filters["format"]}')
+    if filters['sort'] not in SORTS:
+        raise ValueError(f'Неизвестная сортировка: {filters["sort"]}')
+    if args.get('limit'):
+        try:
+            filters['limit'] = int(args['limit'])
+        except ValueError:
+            raise ValueError('Параметр limit должен быть числом')
+        if not 1 <= filters['limit'] <= MAX_LIMIT:
+            raise ValueError(f'Параметр limit должен быть от 1 до {MAX_LIMIT}')
+    if args.get('cursor'):
+        filters['cursor'] = decode_cursor(args['cursor'], filters['sort'])
+    return filters
+
+
+def build_filter_clause(user_id, filters):
+    clauses = ['user_id = ?']
+    params = [user_id]
+    if filters['date_from']:
+        clauses.append('date >= ?')
+        params.append(filters['date_from'])
+    if filters['date_to']:
+        clauses.append('date <= ?')
+        params.append(filters['date_to'])
+    if filters['category']:
+        clauses.append('category = ?')
+        params.append(filters['category'])
+    return clauses, params
+
+
+# Фильтрация, сортировка и постраничный вывод выполняются в SQL.
+# Курсор хранит (значение сортировки, id) последней строки страницы,
+# поэтому следующая страница ищется по индексу, а не через OFFSET.
+# archives — архивные таблицы, которые тоже нужно просмотреть: каждая отдаёт
+# свои первые limit строк по индексу, общий порядок собирается по объединению.
+def build_expense_query(user_id, filters, limit=None, archives=()):
+    column, direction = SORTS[filters['sort']]
+    clauses, params = build_filter_clause(user_id, filters)
+    if filters['cursor']:
+        operator = '>' if direction == 'ASC' else '<'
+        clauses.append(f'({column}, id) {operator} (?, ?)')
+        params.extend(filters['cursor'])
+    where = " AND ".join(clauses)
+    order = f'ORDER BY {column} {direction}, id {direction}'
+    if archives:
+        inner_limit = ' LIMIT ?' if limit is not None else ''
+        arm_params = params + ([limit] if limit is not None else [])
+        sql = ' UNION ALL '.join(
+            f'SELECT * FROM (SELECT {EXPENSE_COLUMNS} FROM {table} WHERE {where} {order}{inner_limit})'
+            for table in ('expenses',) + tuple(archives))
+        # В объединении сортируем по колонкам результата: amount однозначно следует за amount_cents
+        outer = 'date' if column == 'date' else 'amount'
+        sql += f' ORDER BY {outer} {direction}, id {direction}'
+        params = arm_params * (len(archives) + 1)
+    else:
+        sql = f'SELECT {EXPENSE_COLUMNS} FROM expenses WHERE {where} {order}'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
+
+
+# Архивные таблицы, которые могут дать строки для filters: нижняя граница дат — date_from,
+# а при сортировке по дате по возрастанию ещё и дата из курсора
+def archives_for(conn, filters):
+    column, direction = SORTS[filters['sort']]
+    date_from = filters['date_from']
+    if column == 'date' and direction == 'ASC' and filters['cursor']:
+        date_from = max(date_from or '', filters['cursor'][0])
+    return archive.tables_for_range(conn, date_from, filters['date_to'])
+
+
+# Возвращает строки-кортежи в порядке EXPENSE_FIELDS и курсор следующей страницы
+def fetch_expense_page(conn, user_id, filters):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    limit = filters['limit'] + 1
+    archives = archives_for(conn, filters)
+    rows = None
+    if not archives or SORTS[filters['sort']] == ('date', 'DESC'):
+        sql, params = build_expense_query(user_id, filters, limit=limit)
+        rows = cursor.execute(sql, params).fetchall()
+        # Новые сначала: все архивные строки старше границы, поэтому если страница
+        # целиком набрана из expenses не старше её, в архив идти не нужно
+        if archives and (len(rows) < limit or rows[-1][3] < max(before for _, before in archives)):
+            rows = None
+    if rows is None:
+        sql, params = build_expense_query(user_id, filters, limit=limit,
+                                          archives=[table for table, _ in archives])
+        rows = cursor.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > filters['limit']:
+        rows = rows[:filters['limit']]
+        expense_id, _, amount, date, _, _ = rows[-1]
+        column, _ = SORTS[filters['sort']]
+        value = date if column == 'date' else round(amount * 100)
+        next_cursor = encode_cursor(filters['sort'], value, expense_id)
+    return rows, next_cursor
+
+
+# Построчная выгрузка без загрузки всего списка в память: строки читаются
+# из курсора пачками по batch_size и сразу отдаются вызывающему коду
+def iter_expenses(conn, user_id, filters, batch_size=1000):
+    sql, params = build_expense_query(user_id, filters,
+                                      archives=[table for table, _ in archives_for(conn, filters)])
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+
+# Строка поиска превращается в запрос FTS5: каждое слово — фраза в кавычках
+# (спецсимволы синтаксиса FTS5 не работают), последнее слово ищется по префиксу
+# (если в нём не меньше SEARCH_MIN_PREFIX букв).
+# Поиск ограничен записями пользователя через индексированную колонку user_id.
+def build_search_query(user_id, text):
+    words = re.findall(r'\w+', text)
+    if not words:
+        raise ValueError('Пустой поисковый запрос')
+    terms = [f'"{word}"' for word in words]
+    if len(words[-1]) >= SEARCH_MIN_PREFIX:
+        terms[-1] += '*'
+    return f'user_id : "{int(user_id)}" AND {{description category}} : ({" AND ".join(terms)})'
+
+
+# Порядок выдачи: candidates самых новых совпадений по релевантности (сначала совпавшие
+# в описании, затем только в категории; короче описание — выше), за ними остальные от
+# новых к старым. bm25 (ORDER BY rank) считает вес каждого совпадения и статистику слов
+# по всей таблице, и широкий запрос у пользователя с десятками тысяч расходов стоил
+# десятки мс; теперь запрос читает из индекса не больше candidates + offset строк.
+# Когда неархивные совпадения кончаются, идут совпадения из архива (archive.py).
+def search_expenses(conn, user_id, text, limit, offset=0, candidates=SEARCH_RANK_CANDIDATES):
+    match = build_search_query(user_id, text)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    end = offset + limit + 1
+    rows = []
+    if offset < candidates:
+        rows = cursor.execute('''
+            SELECT e.id, e.description, e.amount_cents / 100.0, e.date, e.category, e.user_id
+            FROM (
+                SELECT rowid AS id, instr(highlight(expenses_fts, 0, char(1), ''), char(1)) > 0 AS in_description
+                FROM expenses_fts WHERE expenses_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+            ) AS c
+            JOIN expenses e ON e.id = c.id
+            ORDER BY c.in_description DESC, length(e.description), c.id DESC
+            LIMIT ? OFFSET ?
+        ''', (match, candidates, min(end, candidates) - offset, offset)).fetchall()
+    # Страница заходит за ранжированные совпадения (и они не кончились раньше)
+    if end > candidates and (offset >= candidates or len(rows) == candidates - offset):
+        start = max(offset, candidates)
+        rows += cursor.execute('''
+            SELECT e.id, e.description, e.amount_cents / 100.0, e.date, e.category, e.user_id
+            FROM (
+                SELECT rowid AS id FROM expenses_fts WHERE expenses_fts MATCH ? ORDER BY rowid DESC LIMIT ? OFFSET ?
+            ) AS c
+            JOIN expenses e ON e.id = c.id
+            ORDER BY c.id DESC
+        ''', (match, end - start, start)).fetchall()
+    if len(rows) <= limit and archive.archived_years(conn):
+        # Если страница начинается дальше неархивных совпадений, их число нужно знать для сдвига в архиве
+        hot_total = offset + len(rows) if rows else conn.execute(
+            'SELECT COUNT(*) FROM expenses_fts WHERE expenses_fts MATCH ?', (match,)).fetchone()[0]
+        rows += archive.search_archived(conn, match, limit + 1 - len(rows), max(offset - hot_total, 0))
+    next_offset = offset + limit if len(rows) > limit else None
+    return rows[:limit], next_offset
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# LRU-кэш объектов User с ограниченным временем жизни записи.
+# Кэш живёт в памяти воркера, поэтому TTL ограничивает, как долго
+# другой воркер может видеть устаревшие данные пользователя.
+class UserCache:
+    def __init__(self, max_size=1024, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None and item[1] > now:
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._items[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, user):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[user_id] = (user, time.monotonic() + self.ttl)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._items.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }